@@ -0,0 +1,211 @@
+"""Benchmark the collector against recorded pages served locally, the
+item storages and the item helpers, and save the results as JSON.
+
+Usage: python benchmarks/collector.py [--fixtures PATH] [--parser ID]
+    [--urls N] [--runs N] [--output FILE]
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(REPO_PATH, 'itemz'))
+sys.path.insert(0, os.path.join(REPO_PATH, 'benchmarks'))
+import itemz
+from replay import FIXTURES_PATH, ReplayServer, load_index
+
+
+# Fixtures replayed when no recording is given, without challenge pages
+# which would fall back to a browser
+DEFAULT_FIXTURES = ['1337x_user.html', '1337x_no_results.html']
+RESULTS_PATH = os.path.join(REPO_PATH, 'benchmarks', 'results')
+STORAGE_SIZES = [100, 1000, 5000]
+ITEMS_PER_FILE = 10
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+            'HEAD'], cwd=REPO_PATH, text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def get_names(path, index):
+    parser_cls = itemz.X1337xHttpParser
+    extractor = itemz.RowTextExtractor(parser_cls.row_xpath,
+        parser_cls.name_xpath, parser_cls.block_classes)
+    for page in index.values():
+        with open(os.path.join(path, page['filename'])) as fd:
+            extractor.feed(fd.read())
+    return [r.splitlines()[0].strip() for r in extractor.texts if r]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'min': round(values[0], 4),
+        'median': round(values[len(values) // 2], 4),
+        'max': round(values[-1], 4),
+        'total': round(sum(values), 4),
+    }
+
+
+def bench_collector(server, parser_id, url_count, runs):
+    """Runs the collector on the replayed pages, the first run finding
+    new items and the next ones unchanged pages.
+    """
+    urls = list(server.index.keys())
+    local_urls = [server.get_url(urls[i % len(urls)], query=f'i={i}')
+        for i in range(url_count)]
+    work_path = tempfile.mkdtemp()
+    work_path_patch = patch.object(itemz, 'WORK_PATH', work_path)
+    work_path_patch.start()
+    config = SimpleNamespace(URLS={parser_id: local_urls},
+        ITEM_STORAGE_PATH=os.path.join(work_path, 'items'))
+    res = []
+    try:
+        for run in range(runs):
+            collector = itemz.ItemCollector(config,
+                notification_sink=lambda title, body: None)
+            start_ts = time.time()
+            collector.run()
+            duration = time.time() - start_ts
+            metrics_file = os.path.join(work_path, 'metrics.jsonl')
+            with open(metrics_file) as fd:
+                spans = [json.loads(r) for r in fd]
+            os.remove(metrics_file)
+            phases = {}
+            for span in spans:
+                phases.setdefault(span['name'], []).append(span['duration'])
+            parse_spans = [r for r in spans if r['name'] == 'parse']
+            res.append({
+                'seconds': round(duration, 4),
+                'unchanged_urls': collector.unchanged_count,
+                'url_latency': summarize(r['duration']
+                    for r in parse_spans),
+                'commands': sum(r.get('commands') or 0
+                    for r in parse_spans),
+                'rows': sum(r.get('rows') or 0 for r in parse_spans),
+                'phases': {k: summarize(v) for k, v in phases.items()},
+            })
+            itemz.SqliteItemStorage.close()
+    finally:
+        work_path_patch.stop()
+        shutil.rmtree(work_path)
+    return {'parser_id': parser_id, 'urls': url_count, 'runs': res}
+
+
+def _seed_storage(storage_cls, base_path, url, names):
+    if storage_cls is itemz.ItemStorage:
+        storage = storage_cls(base_path, url)
+        itemz.makedirs(storage.path)
+        for i in range(0, len(names), ITEMS_PER_FILE):
+            with open(storage._get_filename(), 'w') as fd:
+                fd.write(itemz.to_json({r: i
+                    for r in names[i:i + ITEMS_PER_FILE]}))
+    else:
+        items = {r: i for i, r in enumerate(names)}
+        storage_cls(base_path, url).save(items, items)
+
+
+def bench_storage():
+    """Measures the load, diff and save times of the storage backends as
+    the history grows.
+    """
+    res = {}
+    url = 'https://example.com/'
+    for backend, storage_cls in itemz.STORAGE_CLASSES.items():
+        for size in STORAGE_SIZES:
+            base_path = tempfile.mkdtemp()
+            try:
+                names = [f'item {i}' for i in range(size * ITEMS_PER_FILE)]
+                _seed_storage(storage_cls, base_path, url, names)
+                all_items = {r: 1 for r in names[-50:] + ['new item']}
+                start_ts = time.time()
+                storage = storage_cls(base_path, url)
+                load_ts = time.time()
+                new_items = storage.get_new_items(all_items)
+                diff_ts = time.time()
+                storage.save(all_items, new_items)
+                end_ts = time.time()
+                assert list(new_items.keys()) == ['new item']
+                res.setdefault(backend, []).append({
+                    'files': size if storage_cls is itemz.ItemStorage
+                        else None,
+                    'items': len(names),
+                    'load': round(load_ts - start_ts, 4),
+                    'diff': round(diff_ts - load_ts, 4),
+                    'save': round(end_ts - diff_ts, 4),
+                })
+            finally:
+                itemz.SqliteItemStorage.close()
+                shutil.rmtree(base_path)
+    return res
+
+
+def bench_throughput(names, count=100000, url_counts=(10, 100, 1000)):
+    res = {}
+    # Distinct names, since clean_item is memoized
+    names = names or ['Some Game (v1.0 + DLC) [FitGirl Repack]']
+    names = [f'{names[i % len(names)]} {i}' for i in range(count)]
+    itemz.clean_item.cache_clear()
+    start_ts = time.time()
+    for name in names:
+        itemz.clean_item(name)
+    res['clean_item_per_second'] = int(count / (time.time() - start_ts))
+    for url_count in url_counts:
+        urls = [f'https://1337x.to/sort-search/game {i} repack/time/desc/1/'
+            for i in range(url_count)]
+        start_ts = time.time()
+        url_gen = itemz.URLIdGenerator(urls)
+        for url in urls:
+            url_gen.shorten(url)
+        res[f'url_ids_per_second_{url_count}'] = int(
+            url_count / (time.time() - start_ts))
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', default=FIXTURES_PATH,
+        help='recorded pages path, see replay.py')
+    parser.add_argument('--parser', default='1337x_http')
+    parser.add_argument('--urls', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    index = load_index(args.fixtures, DEFAULT_FIXTURES)
+    with ReplayServer(args.fixtures, index) as server:
+        collector_res = bench_collector(server, args.parser, args.urls,
+            args.runs)
+    res = {
+        'ts': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'collector': collector_res,
+        'storage': bench_storage(),
+        'throughput': bench_throughput(get_names(args.fixtures, index)),
+    }
+    output = args.output or os.path.join(RESULTS_PATH,
+        f'collector-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    itemz.save_json(output, res)
+    print(itemz.to_json(res))
+    print(f'saved results to {output}')
+
+
+if __name__ == '__main__':
+    main()
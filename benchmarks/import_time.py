@@ -0,0 +1,77 @@
+"""Measure the cold import time of itemz and the slowest imported modules.
+
+Usage: python benchmarks/import_time.py [--runs N] [--max-seconds S]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Modules which must only be imported once a browser parser is used
+BROWSER_MODULES = ['selenium', 'webutils', 'psutil']
+
+
+def get_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(REPO_PATH, 'itemz')]
+        + [r for r in [env.get('PYTHONPATH')] if r])
+    return env
+
+
+def measure(runs):
+    durations = []
+    for i in range(runs):
+        start_ts = time.time()
+        subprocess.check_call([sys.executable, '-c', 'import itemz'],
+            env=get_env())
+        durations.append(time.time() - start_ts)
+    return sorted(durations)[len(durations) // 2]
+
+
+def get_slowest_modules(count=15):
+    """Returns the modules with the highest cumulative import time."""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+        'import itemz'], env=get_env(), capture_output=True, text=True,
+        check=True).stderr
+    res = []
+    prefix = 'import time:'
+    for line in output.splitlines():
+        if not line.startswith(prefix) or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len(prefix):].split('|')
+        res.append((int(cumulative), name.strip()))
+    return sorted(res, reverse=True)[:count]
+
+
+def get_loaded_browser_modules():
+    code = ('import sys, itemz; print(" ".join(r for r in '
+        f'{BROWSER_MODULES!r} if r in sys.modules))')
+    return subprocess.check_output([sys.executable, '-c', code],
+        env=get_env(), text=True).split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-seconds', type=float)
+    args = parser.parse_args()
+
+    duration = measure(args.runs)
+    print(f'median import time: {duration:.03f} seconds '
+        f'({args.runs} runs, including the interpreter startup)')
+    print('slowest modules (cumulative microseconds):')
+    for cumulative, name in get_slowest_modules():
+        print(f'{cumulative:>10} {name}')
+    loaded = get_loaded_browser_modules()
+    if loaded:
+        print(f'error: browser modules imported: {", ".join(loaded)}')
+        sys.exit(1)
+    if args.max_seconds and duration > args.max_seconds:
+        print(f'error: import time exceeds {args.max_seconds} seconds')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
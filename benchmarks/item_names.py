@@ -0,0 +1,73 @@
+"""Measure the item name normalization throughput, compared to the
+previous one regex pass per tag kind.
+
+Usage: python benchmarks/item_names.py [count]
+"""
+import os
+import random
+import re
+import sys
+import time
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(REPO_PATH, 'itemz'))
+import itemz
+
+
+TEMPLATES = [
+    '{title} (v{version} + {count} DLCs, MULTi{count}) [FitGirl Repack]',
+    '{title}: Deluxe Edition (v{version} + Bonus Content, MULTi{count}) '
+        '[FitGirl Repack, Selective Download - from {count}.2 GB]',
+    '[DL] {title} [P] [RUS + ENG] ({year}, Action) ({version}) [Portable]',
+    '{title} v{version} - DODI Repack',
+    '{title} ({version} + All DLCs, ...',
+    '{title}',
+]
+WORDS = ['Monster', 'Hunter', 'Wilds', 'Noire', 'Ring', 'Elden', 'Cyber',
+    'Ultimate', 'Dark', 'Souls', 'Battle', 'Field', 'Age', 'Empires']
+
+
+def legacy_clean_item(item):
+    res = re.sub(r'\(.*?\)', '', item).strip()
+    res = re.sub(r'\[.*?\]', '', res).strip()
+    res = re.sub(r'[\(][^\(]*$|[\[][^\[]*$', '', res).strip()
+    return res or item
+
+
+def get_names(count, seed=0):
+    rand = random.Random(seed)
+    return [rand.choice(TEMPLATES).format(
+        title=' '.join(rand.sample(WORDS, rand.randint(1, 4))),
+        version=f'{rand.randint(1, 9)}.{rand.randint(0, 999)}',
+        count=rand.randint(1, 30),
+        year=rand.randint(1990, 2025),
+    ) for i in range(count)]
+
+
+def measure(func, names):
+    start_ts = time.time()
+    func(names)
+    return int(len(names) / (time.time() - start_ts))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    names = get_names(count)
+    # Most names of a run were already seen in the previous ones
+    repeated = names[:count // 10] * 10
+    res = {
+        'legacy': measure(lambda x: [legacy_clean_item(r) for r in x],
+            names),
+        'uncached': measure(lambda x: [itemz.clean_item.__wrapped__(r)
+            for r in x], names),
+        'batch': measure(itemz.clean_items, names),
+        'batch_repeated': measure(itemz.clean_items, repeated),
+        'canonical': measure(lambda x: itemz.clean_items(x, canonical=True),
+            names),
+    }
+    assert [legacy_clean_item(r) for r in names] == itemz.clean_items(names)
+    for name, value in res.items():
+        print(f'{name:16} {value:>10} names/s')
+
+
+if __name__ == '__main__':
+    main()
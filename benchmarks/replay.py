@@ -0,0 +1,96 @@
+"""Record listing pages and replay them from a local HTTP server.
+
+Usage: python benchmarks/replay.py <path> <parser_id> <url> ...
+"""
+from functools import partial
+import hashlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import threading
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(REPO_PATH, 'itemz'))
+import itemz
+
+
+FIXTURES_PATH = os.path.join(REPO_PATH, 'tests', 'fixtures')
+INDEX_FILENAME = 'index.json'
+
+
+def get_filename(url):
+    return f'{hashlib.md5(url.encode("utf-8")).hexdigest()}.html'
+
+
+def record(path, parser_id, urls):
+    """Saves the pages of urls once loaded by the parser, indexed by url
+    in the path index file.
+    """
+    index_file = os.path.join(path, INDEX_FILENAME)
+    index = itemz.load_json(index_file, {})
+    parser = itemz.PARSERS[parser_id]()
+    try:
+        for url in urls:
+            items = parser.parse(url)
+            filename = get_filename(url)
+            with open(os.path.join(path, filename), 'w') as fd:
+                fd.write(parser.driver.page_source)
+            index[url] = {
+                'filename': filename,
+                'parser_id': parser_id,
+                'items': len(items),
+            }
+            print(f'recorded {len(items)} items from {url}')
+    finally:
+        parser.quit()
+    itemz.save_json(index_file, index)
+
+
+def load_index(path, filenames=None):
+    """Returns the recorded pages by url, or the filenames pages by
+    filename if the path has no index.
+    """
+    index = itemz.load_json(os.path.join(path, INDEX_FILENAME))
+    if index is None:
+        index = {r: {'filename': r} for r in filenames or []}
+    return index
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer:
+    """Serves recorded pages, at local urls mapped from the recorded ones."""
+
+    def __init__(self, path, index):
+        self.index = index
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+            partial(QuietHandler, directory=path))
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def get_url(self, url, query=None):
+        res = f'{self.base_url}/{self.index[url]["filename"]}'
+        return f'{res}?{query}' if query else res
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever,
+            daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) < 3:
+        print(__doc__)
+        sys.exit(1)
+    itemz.makedirs(args[0])
+    record(args[0], args[1], args[2:])
+
+
+if __name__ == '__main__':
+    main()
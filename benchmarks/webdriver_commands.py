@@ -0,0 +1,51 @@
+"""Count WebDriver commands per page, legacy vs batched extraction.
+
+Usage: python benchmarks/webdriver_commands.py [parser_id url ...]
+"""
+import os
+import sys
+import time
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(REPO_PATH, 'itemz'))
+import itemz
+
+
+URLS = {
+    '1337x': [
+        'https://1337x.to/user/FitGirl/',
+    ],
+    'rutracker': [
+        'https://rutracker.org/forum/tracker.php?f=557',
+    ],
+}
+
+
+def measure(parser_id, url, batch_extract):
+    parser = itemz.PARSERS[parser_id]()
+    parser.batch_extract = batch_extract
+    try:
+        parser.command_count = 0
+        start_ts = time.time()
+        items = parser.parse(url)
+        return {
+            'items': len(items),
+            'commands': parser.command_count,
+            'seconds': round(time.time() - start_ts, 3),
+        }
+    finally:
+        parser.quit()
+
+
+def main():
+    args = sys.argv[1:]
+    urls = {args[0]: args[1:]} if args else URLS
+    for parser_id, parser_urls in urls.items():
+        for url in parser_urls:
+            for batch_extract in (False, True):
+                res = measure(parser_id, url, batch_extract)
+                mode = 'batched' if batch_extract else 'legacy'
+                print(f'{parser_id} {mode:8} {url}: {res}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,36 @@
-from functools import reduce
+from array import array
+from bisect import bisect_left
+import codecs
+from contextlib import contextmanager
+from functools import lru_cache
 from glob import glob
 import hashlib
-import inspect
+from html.parser import HTMLParser
+from itertools import count
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import queue
 import re
 import shutil
+import socket
+import sqlite3
 import sys
+import threading
 import time
+import traceback
 from urllib.parse import urlparse, unquote_plus
 from uuid import uuid4
 
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.common.by import By
-
 from svcutils.service import Notifier, get_file_mtime, get_logger
-from webutils import get_browser_driver
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 BROWSER_ID = 'chrome'
@@ -26,6 +40,65 @@ ITEM_STORAGE_PATH = os.path.join(WORK_PATH, 'items')
 MAX_NOTIF_PER_URL = 4
 MAX_NOTIF_BODY_SIZE = 500
 STORAGE_RETENTION_DELTA = 7 * 24 * 3600
+# Maximum number of old url storages removed per run
+STORAGE_CLEANUP_BUDGET = 100
+BROWSER_TABS = 1
+PARSER_WORKERS = 0
+URLS_PER_WORKER = None
+# Seconds per url after which a worker task is terminated
+WORKER_URL_TIMEOUT = 300
+STORAGE_BACKEND = 'sqlite'
+KNOWN_ITEMS_STOP = 0
+MAX_NEXT_PAGES = 0
+MIN_WAIT_TIMEOUT = 3
+MAX_WAIT_TIMEOUT = 10
+MAX_WAIT_SLICE = 10
+WAIT_TIMEOUT_FACTOR = 3
+BREAKER_FAILURES = 3
+BREAKER_MIN_BACKOFF = 3600
+BREAKER_MAX_BACKOFF = 24 * 3600
+ISOLATED_BROWSER_PROFILES = False
+# Ids of parsers using a browser without images, fonts, ads, etc
+LEAN_BROWSER_PARSERS = set()
+BROWSER_DAEMON = False
+# The lean mode daemon uses the next port
+BROWSER_DAEMON_PORT = 9222
+BROWSER_DAEMON_MAX_PAGES = 500
+BROWSER_DAEMON_MAX_RSS = 1024 * 1024 * 1024
+PIPELINE_QUEUE_SIZE = 10
+NOTIF_WINDOW = 5
+NOTIF_MIN_INTERVAL = 1
+NOTIF_MAX_PER_WINDOW = 8
+# Only process the urls which are due, with intervals adapted to how
+# often they change
+ADAPTIVE_SCHEDULE = False
+SCHEDULE_MIN_INTERVAL = 1800
+SCHEDULE_MAX_INTERVAL = 24 * 3600
+SCHEDULE_BACKOFF_FACTOR = 1.5
+SCHEDULE_HISTORY_SIZE = 10
+# Shared sqlite file used by several collectors to split the urls, each
+# processing the urls it holds a lease on; the item storage path must be
+# shared as well
+SHARD_STORE_PATH = None
+SHARD_WORKER_ID = None
+# Whether this collector delivers the notifications of the other ones and
+# cleans up the item storage
+SHARD_COORDINATOR = False
+SHARD_LEASE_DURATION = 6 * 3600
+# Maximum age of an interrupted run whose processed urls are skipped by
+# the next one
+RUN_RESUME_MAX_AGE = 3 * 3600
+# Maximum number of memoized item names
+ITEM_NAME_CACHE_SIZE = 50000
+# Trailing repack group names removed by the item name canonicalization
+REPACK_GROUPS = ['FitGirl', 'DODI', 'ElAmigos', 'KaOs', 'Xatab', 'Decepticon']
+# Whether the cross url item index matches canonical item names
+CANONICAL_ITEM_INDEX = False
+# Rotation size of the metrics JSON lines file
+METRICS_MAX_SIZE = 10 * 1024 * 1024
+HTTP_TIMEOUT = 10
+HTTP_USER_AGENT = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
 
 try:
     from user_settings import *
@@ -38,24 +111,331 @@ def makedirs(x):
         os.makedirs(x)
 
 
-makedirs(WORK_PATH)
-logger = get_logger(path=WORK_PATH, name=NAME)
-logging.getLogger('selenium').setLevel(logging.INFO)
-logging.getLogger('urllib3').setLevel(logging.INFO)
+# Set up on first use, see setup_logging
+logger = logging.getLogger(NAME)
+logging_ready = False
+
+
+def setup_logging():
+    """Creates WORK_PATH and sets up the logger, deferred from import time
+    to keep the startup fast.
+    """
+    global logger, logging_ready
+    if logging_ready:
+        return
+    makedirs(WORK_PATH)
+    logger = get_logger(path=WORK_PATH, name=NAME)
+    logging.getLogger('selenium').setLevel(logging.INFO)
+    logging.getLogger('urllib3').setLevel(logging.INFO)
+    logging_ready = True
+
+
+# Resolves as soon as the rows are parsed or a marker element is found,
+# or after the timeout, with the rows texts (the first name_xpath match of
+# every row_xpath match), the found marker name and the bytes transferred
+# by the page, so a whole listing is waited for and read in a single
+# WebDriver round trip.
+WAIT_PAGE_SCRIPT = """
+var rowXpath = arguments[0], nameXpath = arguments[1],
+    markers = arguments[2], timeout = arguments[3],
+    callback = arguments[arguments.length - 1];
+function done(res) {
+    var entries = performance.getEntriesByType('navigation').concat(
+        performance.getEntriesByType('resource'));
+    res.transferred = 0;
+    for (var i = 0; i < entries.length; i++) {
+        res.transferred += entries[i].transferSize || 0;
+    }
+    callback(res);
+}
+function evaluate(xpath, node, type) {
+    return document.evaluate(xpath, node, null, type, null);
+}
+function check() {
+    var res = {loading: document.readyState === 'loading', texts: null,
+        marker: null};
+    var rows = evaluate(rowXpath, document,
+        XPathResult.ORDERED_NODE_SNAPSHOT_TYPE);
+    if (rows.snapshotLength) {
+        res.texts = [];
+        for (var i = 0; i < rows.snapshotLength; i++) {
+            var el = evaluate(nameXpath, rows.snapshotItem(i),
+                XPathResult.FIRST_ORDERED_NODE_TYPE).singleNodeValue;
+            res.texts.push(el ? el.innerText : null);
+        }
+        return res;
+    }
+    for (var name in markers) {
+        if (evaluate(markers[name], document,
+                XPathResult.FIRST_ORDERED_NODE_TYPE).singleNodeValue) {
+            res.marker = name;
+            break;
+        }
+    }
+    return res;
+}
+function isReady(res) {
+    return (res.texts && !res.loading) || res.marker;
+}
+var res = check();
+if (isReady(res) || timeout <= 0) {
+    done(res);
+    return;
+}
+var timer = null;
+var observer = new MutationObserver(onChange);
+function finish(res) {
+    observer.disconnect();
+    clearTimeout(timer);
+    document.removeEventListener('DOMContentLoaded', onChange);
+    done(res);
+}
+function onChange() {
+    var res = check();
+    if (isReady(res)) {
+        finish(res);
+    }
+}
+observer.observe(document, {childList: true, subtree: true});
+document.addEventListener('DOMContentLoaded', onChange);
+timer = setTimeout(function() { finish(check()); }, timeout);
+"""
+NEXT_PAGE_URL_SCRIPT = """
+var el = document.evaluate(arguments[0], document, null,
+    XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+return el ? el.href : null;
+"""
 
 
 def to_json(x):
     return json.dumps(x, indent=4, sort_keys=True)
 
 
+def load_json(file, default=None):
+    if not os.path.exists(file):
+        return default
+    try:
+        with open(file) as fd:
+            return json.load(fd)
+    except Exception:
+        logger.exception(f'failed to load file {file}')
+        return default
+
+
+def save_json(file, data):
+    makedirs(os.path.dirname(file))
+    tmp_file = f'{file}.tmp'
+    with open(tmp_file, 'w') as fd:
+        fd.write(to_json(data))
+    os.replace(tmp_file, file)
+
+
+class Metrics:
+    """Collects timing spans of the run phases, written as JSON lines and
+    summed by phase and parser in a Prometheus textfile.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **fields):
+        """Records the duration of the block, which can set fields on
+        the yielded dict, e.g. the row count.
+        """
+        start_ts = time.time()
+        try:
+            yield fields
+        finally:
+            self.add(name, time.time() - start_ts, ts=start_ts, **fields)
+
+    def add(self, name, duration, ts=None, **fields):
+        span = {
+            'name': name,
+            'ts': round(ts or time.time() - duration, 3),
+            'duration': round(duration, 4),
+        }
+        span.update(fields)
+        with self.lock:
+            self.spans.append(span)
+
+    def extend(self, spans):
+        with self.lock:
+            self.spans.extend(spans)
+
+    def pop_spans(self):
+        with self.lock:
+            res, self.spans = self.spans, []
+        return res
+
+    def _write_spans(self, spans):
+        makedirs(WORK_PATH)
+        file = os.path.join(WORK_PATH, 'metrics.jsonl')
+        if os.path.exists(file) and os.path.getsize(file) > METRICS_MAX_SIZE:
+            os.replace(file, f'{file}.1')
+        with open(file, 'a') as fd:
+            for span in spans:
+                fd.write(f'{json.dumps(span, sort_keys=True)}\n')
+
+    def _write_textfile(self, spans, gauges):
+        phases = {}
+        for span in spans:
+            key = span['name'], span.get('parser') or ''
+            phase = phases.setdefault(key, {'seconds': 0, 'count': 0,
+                'rows': 0, 'commands': 0})
+            phase['seconds'] += span['duration']
+            phase['count'] += 1
+            phase['rows'] += span.get('rows') or 0
+            phase['commands'] += span.get('commands') or 0
+        lines = []
+        for metric in ['seconds', 'count', 'rows', 'commands']:
+            lines.append(f'# TYPE {NAME}_phase_{metric} gauge')
+            for (name, parser_id), phase in sorted(phases.items()):
+                lines.append(f'{NAME}_phase_{metric}{{phase="{name}",'
+                    f'parser="{parser_id}"}} {phase[metric]:g}')
+        for name, value in sorted(gauges.items()):
+            lines.append(f'# TYPE {NAME}_{name} gauge')
+            lines.append(f'{NAME}_{name} {value:g}')
+        file = os.path.join(WORK_PATH, f'{NAME}.prom')
+        with open(f'{file}.tmp', 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        os.replace(f'{file}.tmp', file)
+
+    def save(self, gauges):
+        """Writes the spans collected since the last save, and the
+        gauges of the run.
+        """
+        spans = self.pop_spans()
+        self._write_spans(spans)
+        self._write_textfile(spans, gauges)
+
+
+metrics = Metrics()
+
+
+# Parenthesized and bracketed groups, and a trailing unclosed one, e.g.
+# "Name (v1.0 + DLC...", in a single pass
+ITEM_TAGS_PATTERN = re.compile(r'\(.*?\)|\[.*?\]|\([^(]*$|\[[^\[]*$')
+ITEM_VERSION_PATTERN = re.compile(r'\bv\d+(?:\.\d+)*\w*|\b\d+(?:\.\d+)+\b',
+    re.IGNORECASE)
+ITEM_GROUP_PATTERN = re.compile(r'[\s\-_.]+(?:(?:'
+    + '|'.join(re.escape(r) for r in REPACK_GROUPS)
+    + r')(?:[\s\-_]+repack)?|repack)$', re.IGNORECASE)
+
+
+@lru_cache(maxsize=ITEM_NAME_CACHE_SIZE)
 def clean_item(item):
-    res = re.sub(r'\(.*?\)', '', item).strip()
-    res = re.sub(r'\[.*?\]', '', res).strip()
-    res = re.sub(r'[\(][^\(]*$|[\[][^\[]*$', '', res).strip()
-    return res or item
+    return ITEM_TAGS_PATTERN.sub('', item).strip() or item
+
+
+@lru_cache(maxsize=ITEM_NAME_CACHE_SIZE)
+def canonicalize_item(item):
+    """Returns the clean item name lowercased, without version tags and
+    repack group suffixes, to match names across sources.
+    """
+    res = clean_item(item)
+    res = ITEM_GROUP_PATTERN.sub('', res)
+    res = ITEM_VERSION_PATTERN.sub('', res)
+    res = ' '.join(res.casefold().split()).strip(' -_.,:')
+    return res or clean_item(item).casefold()
+
+
+def clean_items(items, canonical=False):
+    """Returns the clean names of a batch of item names."""
+    func = canonicalize_item if canonical else clean_item
+    return [func(r) for r in items]
+
+
+class ManifestStorage:
+    """Base of the storages keeping a file or dir per url, tracked in a
+    manifest so the cleanup only visits the expired ones.
+    """
+    manifest_filename = None
+    manifest_lock = threading.Lock()
+
+    @classmethod
+    def _get_name(cls, url):
+        """Returns the file or dir name of the url in the storage path."""
+        raise NotImplementedError()
+
+    @classmethod
+    def _list_paths(cls, base_path):
+        raise NotImplementedError()
+
+    @classmethod
+    def _get_path_mtime(cls, path):
+        raise NotImplementedError()
+
+    @classmethod
+    def _remove_path(cls, path):
+        raise NotImplementedError()
 
+    @classmethod
+    def _get_manifest_entry(cls, mtime):
+        return {'mtime': mtime, 'next_ts': mtime + STORAGE_RETENTION_DELTA}
+
+    @classmethod
+    def _load_manifest(cls, base_path):
+        """Returns the last write time and next eligible removal time by
+        storage name, scanning the storage path if the manifest is
+        missing.
+        """
+        res = load_json(os.path.join(base_path, cls.manifest_filename))
+        if res is None:
+            res = {os.path.basename(r): cls._get_manifest_entry(
+                    cls._get_path_mtime(r))
+                for r in cls._list_paths(base_path)}
+        return res
+
+    @classmethod
+    def _update_manifest(cls, base_path, url):
+        with cls.manifest_lock:
+            manifest = cls._load_manifest(base_path)
+            manifest[cls._get_name(url)] = cls._get_manifest_entry(
+                int(time.time()))
+            save_json(os.path.join(base_path, cls.manifest_filename),
+                manifest)
+
+    @classmethod
+    def cleanup(cls, base_path, all_urls):
+        names = {cls._get_name(r) for r in all_urls}
+        now_ts = time.time()
+        budget = STORAGE_CLEANUP_BUDGET
+        with cls.manifest_lock:
+            manifest = cls._load_manifest(base_path)
+            for name, entry in sorted(manifest.items(),
+                    key=lambda x: x[1]['next_ts']):
+                if entry['next_ts'] > now_ts:
+                    break
+                if name in names:
+                    continue
+                if not budget:
+                    logger.info('reached the storage cleanup budget')
+                    break
+                path = os.path.join(base_path, name)
+                if not os.path.exists(path):
+                    del manifest[name]
+                    continue
+                # Written without updating the manifest
+                mtime = cls._get_path_mtime(path)
+                if mtime > now_ts - STORAGE_RETENTION_DELTA:
+                    manifest[name] = cls._get_manifest_entry(mtime)
+                    continue
+                cls._remove_path(path)
+                del manifest[name]
+                budget -= 1
+                logger.info(f'removed old storage path {path}')
+            save_json(os.path.join(base_path, cls.manifest_filename),
+                manifest)
+
+
+class ItemStorage(ManifestStorage):
+    manifest_filename = 'manifest.json'
 
-class ItemStorage:
     def __init__(self, base_path, url):
         self.base_path = base_path
         self.url = url
@@ -70,17 +450,22 @@ class ItemStorage:
         return hashlib.md5(url.encode('utf-8')).hexdigest()
 
     @classmethod
-    def cleanup(cls, base_path, all_urls):
-        dirnames = {cls._get_dirname(r) for r in all_urls}
-        min_ts = time.time() - STORAGE_RETENTION_DELTA
-        for path in glob(os.path.join(base_path, '*')):
-            if os.path.basename(path) in dirnames:
-                continue
-            mtimes = [get_file_mtime(r)
-                for r in glob(os.path.join(path, '*'))]
-            if not mtimes or max(mtimes) < min_ts:
-                shutil.rmtree(path)
-                logger.info(f'removed old storage path {path}')
+    def _get_name(cls, url):
+        return cls._get_dirname(url)
+
+    @classmethod
+    def _list_paths(cls, base_path):
+        return [r for r in glob(os.path.join(base_path, '*'))
+            if os.path.isdir(r)]
+
+    @classmethod
+    def _get_path_mtime(cls, path):
+        return int(max([get_file_mtime(r)
+            for r in glob(os.path.join(path, '*'))] or [0]))
+
+    @classmethod
+    def _remove_path(cls, path):
+        shutil.rmtree(path)
 
     def _load_file_items(self, file):
         try:
@@ -108,202 +493,1975 @@ class ItemStorage:
         file = self._get_filename()
         with open(file, 'w') as fd:
             fd.write(to_json(new_items))
+        self._update_manifest(self.base_path, self.url)
+
+    def get_new_items(self, all_items):
+        return {k: v for k, v in all_items.items() if k not in self.items}
+
+
+migration_lock = threading.Lock()
+
+
+def migrate_legacy_items(base_path, url, store):
+    """Passes the items and last write time of the url ItemStorage files
+    to store and removes the files once it returned, so a failure keeps
+    the url history.
+    """
+    with migration_lock:
+        if not os.path.exists(os.path.join(base_path,
+                ItemStorage._get_dirname(url))):
+            return
+        legacy = ItemStorage(base_path, url)
+        mtime = int(max([get_file_mtime(r) for r in glob(
+            os.path.join(legacy.path, '*'))] or [time.time()]))
+        store(legacy.items, mtime)
+        shutil.rmtree(legacy.path)
+    logger.info(f'migrated {len(legacy.items)} items from {legacy.path}')
+
+
+class SqliteItemStorage:
+    """Stores items of all urls in a single SQLite database, keyed by
+    (url, name), so membership checks don't load the url history.
+    """
+    filename = 'items.db'
+    # By process, since forked workers can't use the collector connection
+    connections = {}
+    # The connection is shared by the collector threads
+    lock = threading.RLock()
+
+    def __init__(self, base_path, url):
+        self.base_path = base_path
+        self.url = url
+        self.conn = self._get_connection(base_path)
+        self._migrate()
+
+    @classmethod
+    def _get_connection(cls, base_path):
+        file = os.path.join(base_path, cls.filename)
+        key = os.getpid(), file
+        if key not in cls.connections:
+            makedirs(base_path)
+            conn = sqlite3.connect(file, timeout=60,
+                check_same_thread=False)
+            # WAL requires shared memory, which the collectors sharing
+            # the storage path from other hosts don't have
+            if SHARD_STORE_PATH:
+                conn.execute('PRAGMA journal_mode=DELETE')
+            else:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                'url TEXT NOT NULL, name TEXT NOT NULL, '
+                'first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL, '
+                'PRIMARY KEY (url, name)) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS items_last_seen '
+                'ON items (url, last_seen)')
+            cls.connections[key] = conn
+        return cls.connections[key]
+
+    @classmethod
+    def close(cls):
+        for key in [r for r in cls.connections if r[0] == os.getpid()]:
+            cls.connections.pop(key).close()
+
+    def _migrate(self):
+        def store(items, mtime):
+            with self.lock, self.conn:
+                self.conn.executemany('INSERT OR IGNORE INTO items '
+                    '(url, name, first_seen, last_seen) VALUES (?, ?, ?, ?)',
+                    [(self.url, k, v, mtime) for k, v in items.items()])
+
+        migrate_legacy_items(self.base_path, self.url, store)
+
+    @classmethod
+    def cleanup(cls, base_path, all_urls):
+        """Removes the items of up to STORAGE_CLEANUP_BUDGET old urls,
+        found through the (url, last_seen) index.
+        """
+        min_ts = int(time.time() - STORAGE_RETENTION_DELTA)
+        conn = cls._get_connection(base_path)
+        with cls.lock, conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS all_urls '
+                '(url TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM all_urls')
+            conn.executemany('INSERT OR IGNORE INTO all_urls VALUES (?)',
+                [(r,) for r in all_urls])
+            urls = [r[0] for r in conn.execute('SELECT url FROM items '
+                'WHERE url NOT IN (SELECT url FROM all_urls) '
+                'GROUP BY url HAVING MAX(last_seen) < ? LIMIT ?',
+                (min_ts, STORAGE_CLEANUP_BUDGET))]
+            conn.executemany('DELETE FROM items WHERE url = ?',
+                [(r,) for r in urls])
+        for url in urls:
+            logger.info(f'removed old storage items for {url}')
+        if len(urls) == STORAGE_CLEANUP_BUDGET:
+            logger.info('reached the storage cleanup budget')
+        ItemStorage.cleanup(base_path, all_urls)
+
+    def get_new_items(self, all_items, chunk_size=500):
+        names = list(all_items.keys())
+        known = set()
+        for i in range(0, len(names), chunk_size):
+            chunk = names[i:i + chunk_size]
+            with self.lock:
+                known.update(r[0] for r in self.conn.execute('SELECT name '
+                    'FROM items WHERE url = ? AND name IN '
+                    f'({",".join("?" * len(chunk))})', [self.url] + chunk))
+        return {k: v for k, v in all_items.items() if k not in known}
+
+    def save(self, all_items, new_items):
+        now_ts = int(time.time())
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO items '
+                '(url, name, first_seen, last_seen) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (url, name) DO UPDATE SET '
+                'last_seen = excluded.last_seen',
+                [(self.url, k, new_items.get(k, v), now_ts)
+                    for k, v in all_items.items()])
+            # Items still on the page are refreshed above, so this only
+            # forgets items gone from the listing for a while.
+            res = self.conn.execute('DELETE FROM items '
+                'WHERE url = ? AND last_seen < ?',
+                (self.url, now_ts - STORAGE_RETENTION_DELTA))
+        if res.rowcount:
+            logger.debug(f'removed {res.rowcount} old items for {self.url}')
+
+
+class DigestItemStorage(ManifestStorage):
+    """Stores the 64 bits digests of the url item names in a sorted
+    array file, which is memory mapped and binary searched, so loading
+    is constant time and items cost 8 bytes.
+
+    Unlike the exact backends, names are only kept as digests, so items
+    are never forgotten until the url itself is cleaned up.
+    """
+    extension = '.digests'
+    typecode = 'Q'
+    manifest_filename = 'digests-manifest.json'
+
+    def __init__(self, base_path, url):
+        self.base_path = base_path
+        self.url = url
+        self.file = os.path.join(base_path, self._get_name(url))
+        self._migrate()
+        self.mmap = None
+        self.digests = self._load()
+
+    @classmethod
+    def _get_name(cls, url):
+        return f'{ItemStorage._get_dirname(url)}{cls.extension}'
+
+    @classmethod
+    def _list_paths(cls, base_path):
+        return glob(os.path.join(base_path, f'*{cls.extension}'))
+
+    @classmethod
+    def _get_path_mtime(cls, path):
+        return int(get_file_mtime(path))
+
+    @classmethod
+    def _remove_path(cls, path):
+        os.remove(path)
+
+    @classmethod
+    def get_digest(cls, name):
+        name = ' '.join(name.split())
+        return int.from_bytes(hashlib.blake2b(name.encode('utf-8'),
+            digest_size=8).digest(), 'little')
+
+    def _migrate(self):
+        migrate_legacy_items(self.base_path, self.url, lambda items, mtime:
+            self._write(sorted({self.get_digest(r) for r in items})))
+
+    def _load(self):
+        if not os.path.exists(self.file) or not os.path.getsize(self.file):
+            return []
+        with open(self.file, 'rb') as fd:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.mmap).cast(self.typecode)
+
+    def _close(self):
+        if self.mmap:
+            self.digests.release()
+            self.mmap.close()
+            self.mmap = None
+        self.digests = []
+
+    def _write(self, digests):
+        makedirs(self.base_path)
+        tmp_file = f'{self.file}.tmp'
+        with open(tmp_file, 'wb') as fd:
+            array(self.typecode, digests).tofile(fd)
+        os.replace(tmp_file, self.file)
+
+    def __contains__(self, name):
+        digest = self.get_digest(name)
+        index = bisect_left(self.digests, digest)
+        return index < len(self.digests) and self.digests[index] == digest
+
+    @classmethod
+    def cleanup(cls, base_path, all_urls):
+        super().cleanup(base_path, all_urls)
+        # Legacy storage dirs not migrated yet
+        ItemStorage.cleanup(base_path, all_urls)
+
+    def get_new_items(self, all_items):
+        return {k: v for k, v in all_items.items() if k not in self}
+
+    def save(self, all_items, new_items):
+        digests = set(self.digests)
+        digests.update(self.get_digest(r) for r in new_items)
+        self._close()
+        self._write(sorted(digests))
+        self.digests = self._load()
+        self._update_manifest(self.base_path, self.url)
+
+
+STORAGE_CLASSES = {
+    'files': ItemStorage,
+    'sqlite': SqliteItemStorage,
+    'digests': DigestItemStorage,
+}
+
+
+def reset_storage_locks():
+    """Replaces the storage locks inherited by a forked worker, which
+    stay locked if a collector thread held them at fork time.
+    """
+    global migration_lock
+    migration_lock = threading.Lock()
+    ManifestStorage.manifest_lock = threading.Lock()
+    SqliteItemStorage.lock = threading.RLock()
+
+
+class KnownItems:
+    """Parser known_items callable, picklable for worker processes."""
+
+    def __init__(self, storage_cls, base_path):
+        self.storage_cls = storage_cls
+        self.base_path = base_path
+
+    def __call__(self, url, names):
+        new_items = self.storage_cls(self.base_path,
+            url).get_new_items(dict.fromkeys(names))
+        return {r for r in names if r not in new_items}
+
+
+class JsonStore:
+    """Dict saved as a JSON file shared by processes and collectors.
+
+    Saving merges the keys updated since the last save into the current
+    file content, so the updates of the others are kept.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.data = load_json(file, {})
+        self.updated = set()
+        self.lock = threading.Lock()
+
+    def _merge(self, current, value):
+        """Returns the value to save for an updated key, current being
+        the file value or None.
+        """
+        return value
+
+    @contextmanager
+    def _lock_file(self):
+        """Serializes the saves of the collectors, which may run on other
+        hosts when sharing the storage path.
+        """
+        makedirs(os.path.dirname(self.file))
+        with open(f'{self.file}.lock', 'w') as fd:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+
+    def save(self, keep=None):
+        """Merges the updated keys, removing the deleted ones, and only
+        keeps the items for which keep(key, value) is true.
+        """
+        with self.lock:
+            if not self.updated and not keep:
+                return
+            with self._lock_file():
+                data = load_json(self.file, {})
+                for key in self.updated:
+                    if key in self.data:
+                        data[key] = self._merge(data.get(key),
+                            self.data[key])
+                    else:
+                        data.pop(key, None)
+                self.data = {k: v for k, v in data.items()
+                    if not keep or keep(k, v)}
+                save_json(self.file, self.data)
+            self.updated = set()
+
+
+class FingerprintStore(JsonStore):
+    """Keeps, per url, a fingerprint of the last processed listing and
+    its HTTP validators, so unchanged pages can be skipped.
+    """
+    filename = 'fingerprints.json'
+
+    def __init__(self, base_path):
+        super().__init__(os.path.join(base_path, self.filename))
+
+    @classmethod
+    def get_fingerprint(cls, items):
+        return hashlib.md5('\n'.join(items).encode('utf-8')).hexdigest()
+
+    def get(self, url):
+        return self.data.get(url) or {}
+
+    def get_validators(self, urls):
+        data = dict(self.data)
+        return {r: data[r]['validators'] for r in urls
+            if (data.get(r) or {}).get('validators')}
+
+    def set(self, url, fingerprint, validators=None):
+        self.data[url] = {
+            'fingerprint': fingerprint,
+            'validators': validators,
+        }
+        self.updated.add(url)
+
+    def save(self, all_urls):
+        super().save(keep=lambda k, v: k in all_urls)
+
+
+class ItemIndex(JsonStore):
+    """Maps cleaned item names to the url and timestamp they were first
+    seen at, across all urls.
+    """
+    filename = 'item_index.json'
+
+    def __init__(self, base_path):
+        super().__init__(os.path.join(base_path, self.filename))
+        # Set by sharded collectors, which must see the items indexed by
+        # the other ones during their runs
+        self.shard_store = None
+
+    def _get_keys(self, names):
+        return clean_items(names, canonical=CANONICAL_ITEM_INDEX)
+
+    def get(self, name):
+        return self.data.get(self._get_keys([name])[0])
+
+    def add(self, url, names):
+        """Indexes names for url and returns the ones first seen at
+        another url.
+        """
+        res = set()
+        now_ts = int(time.time())
+        names = list(names)
+        keys = self._get_keys(names)
+        first_urls = self.shard_store.index_items(url, keys) \
+            if self.shard_store else {}
+        for name, key in zip(names, keys):
+            item = self.data.get(key)
+            if not item:
+                item = self.data[key] = {
+                    'url': first_urls.get(key, url),
+                    'first_seen': now_ts,
+                }
+                self.updated.add(key)
+            if item['url'] != url:
+                res.add(name)
+        return res
+
+    def _merge(self, current, value):
+        # Another collector may have indexed the item first
+        return current or value
+
+    def save(self, all_urls):
+        min_ts = time.time() - STORAGE_RETENTION_DELTA
+        super().save(keep=lambda k, v: v['url'] in all_urls
+            and v['first_seen'] > min_ts)
 
 
 class URLIdGenerator:
-    def __init__(self, urls):
-        self.url_tokens = {u: self._get_tokens(u) for u in urls}
+    """Generates url ids made of the host and of the url tokens found in
+    no other url, using a count of the urls by token.
+    """
+    cache_size = 20
+
+    def __init__(self, urls=()):
+        self.url_tokens = {}
+        self.token_counts = {}
+        for url in urls:
+            self.add(url)
+        self.ids = None
+
+    @classmethod
+    def _get_cache_key(cls, urls):
+        data = '\n'.join(sorted(set(urls)))
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load(cls, file, urls):
+        """Returns a generator for urls with the ids cached in file for
+        this set of urls, computing and caching them if missing.
+        """
+        url_gen = cls(urls)
+        data = load_json(file, {})
+        key = cls._get_cache_key(urls)
+        url_gen.ids = data.get(key)
+        if url_gen.ids is None:
+            data[key] = url_gen.get_ids()
+            save_json(file, dict(list(data.items())[-cls.cache_size:]))
+        return url_gen
 
     def _get_tokens(self, url):
         parsed = urlparse(unquote_plus(url))
         words = re.findall(r'\b\w+\b', f'{parsed.path} {parsed.query}')
         return [r for r in words if len(r) > 1]
 
-    def shorten(self, url):
-        tokens = [v for k, v in self.url_tokens.items() if k != url]
-        if tokens:
-            tokens = set(reduce(lambda x, y: x + y, tokens))
-            tokens = [r for r in self._get_tokens(url) if r not in tokens]
+    def add(self, url):
+        if url in self.url_tokens:
+            return
+        tokens = self._get_tokens(url)
+        self.url_tokens[url] = tokens
+        for token in set(tokens):
+            self.token_counts[token] = self.token_counts.get(token, 0) + 1
+        self.ids = None
+
+    def remove(self, url):
+        tokens = self.url_tokens.pop(url, None)
+        if tokens is None:
+            return
+        for token in set(tokens):
+            self.token_counts[token] -= 1
+            if not self.token_counts[token]:
+                del self.token_counts[token]
+        self.ids = None
+
+    def _get_id(self, url, tokens, own_count):
+        """own_count is the number of times the url tokens are counted,
+        1 if the url is indexed, 0 otherwise.
+        """
+        if len(self.url_tokens) > own_count:
+            tokens = [r for r in tokens
+                if self.token_counts.get(r, 0) == own_count]
         else:
             tokens = []
         return ' '.join([urlparse(url).netloc] + tokens)
 
+    def get_ids(self):
+        """Returns the ids of all the urls."""
+        if self.ids is None:
+            self.ids = {k: self._get_id(k, v, 1)
+                for k, v in self.url_tokens.items()}
+        return self.ids
+
+    def shorten(self, url):
+        if url in self.url_tokens:
+            return self.get_ids()[url]
+        return self._get_id(url, self._get_tokens(url), 0)
+
+
+class SkippedUrlError(Exception):
+    pass
+
+
+class CircuitBreaker(JsonStore):
+    """Tracks consecutive failures by host, persisted across runs.
+
+    After BREAKER_FAILURES consecutive failures, urls of the host are
+    skipped, except for a single probe url once the backoff delay is
+    over, which doubles on every failed probe.
+    """
+
+    def __init__(self, file, notify=None):
+        super().__init__(file)
+        # Callable taking title and body, alerted when a host goes down
+        self.notify = notify
+        self.probing = set()
+
+    def _get_host(self, url):
+        return urlparse(url).netloc
+
+    def allow(self, url):
+        host = self._get_host(url)
+        state = self.data.get(host)
+        if not BREAKER_FAILURES or not state \
+                or state['failures'] < BREAKER_FAILURES:
+            return True
+        if host in self.probing or time.time() < state['next_probe_ts']:
+            return False
+        logger.info(f'probing {host}')
+        self.probing.add(host)
+        return True
+
+    def is_probing(self, url):
+        return self._get_host(url) in self.probing
+
+    def record(self, url, success):
+        host = self._get_host(url)
+        self.updated.add(host)
+        self.probing.discard(host)
+        if success:
+            if self.data.pop(host, None):
+                logger.info(f'{host} is available again')
+            return
+        state = self.data.setdefault(host, {'failures': 0, 'backoff': 0})
+        state['failures'] += 1
+        if not BREAKER_FAILURES or state['failures'] < BREAKER_FAILURES:
+            return
+        is_new = not state['backoff']
+        state['backoff'] = min(max(state['backoff'] * 2, BREAKER_MIN_BACKOFF),
+            BREAKER_MAX_BACKOFF)
+        state['next_probe_ts'] = time.time() + state['backoff']
+        if is_new:
+            logger.error(f'{host} failed {state["failures"]} times in a row')
+            if self.notify:
+                self.notify(f'{NAME} error', f'{host} failed '
+                    f'{state["failures"]} times in a row, skipping its urls '
+                    f'for {state["backoff"]} seconds')
+
+
+class UrlSchedule(JsonStore):
+    """Records the history of urls (last run and change, new items per
+    run, fetch duration) and the interval until they are due again.
+
+    The interval is halved when a run finds new items and multiplied by
+    SCHEDULE_BACKOFF_FACTOR otherwise.
+    """
+
+    def _get_state(self, url):
+        self.updated.add(url)
+        return self.data.setdefault(url, {
+            'interval': SCHEDULE_MIN_INTERVAL,
+            'last_run_ts': 0,
+            'last_change_ts': 0,
+            'new_items': [],
+            'duration': None,
+        })
+
+    def is_due(self, url):
+        state = self.data.get(url)
+        if not state:
+            return True
+        # Allow some slack since runs only happen on service ticks
+        return time.time() >= state['last_run_ts'] + state['interval'] * .9
+
+    def get_due_urls(self, urls):
+        return {k: [u for u in v if self.is_due(u)] for k, v in urls.items()}
+
+    def record_duration(self, url, duration):
+        if duration is None:
+            return
+        with self.lock:
+            self._get_state(url)['duration'] = round(duration, 2)
+
+    def record_run(self, url, new_count):
+        with self.lock:
+            state = self._get_state(url)
+            now_ts = int(time.time())
+            state['last_run_ts'] = now_ts
+            state['new_items'] = (state['new_items']
+                + [new_count])[-SCHEDULE_HISTORY_SIZE:]
+            if new_count:
+                state['last_change_ts'] = now_ts
+                interval = state['interval'] / 2
+            else:
+                interval = state['interval'] * SCHEDULE_BACKOFF_FACTOR
+            state['interval'] = int(min(max(interval, SCHEDULE_MIN_INTERVAL),
+                SCHEDULE_MAX_INTERVAL))
+
+    def save(self, all_urls):
+        super().save(keep=lambda k, v: k in all_urls)
+
+
+class RunJournal:
+    """Checkpoints the progress of a run as JSON lines, removed once the
+    run completes: the processed urls with the notifications of their new
+    items, and the delivered notifications.
+
+    A url and its notifications are written at once after its items are
+    stored, and notifications are marked as delivered before being sent,
+    so replaying an interrupted run never notifies twice.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def load(self):
+        """Returns the start timestamp and urls key of the interrupted run,
+        its processed urls and its undelivered notifications by id.
+        """
+        res = {'ts': 0, 'key': None, 'urls': set(), 'notifs': {}}
+        if not os.path.exists(self.file):
+            return res
+        sent = set()
+        with open(self.file) as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written when the run was killed
+                    logger.warning(f'skipped invalid journal entry {line!r}')
+                    continue
+                if 'start' in entry:
+                    res['ts'], res['key'] = entry['start'], entry['key']
+                res['urls'].update(entry.get('urls', []))
+                res['notifs'].update(entry.get('notifs', {}))
+                sent.update(entry.get('sent', []))
+        res['notifs'] = {k: v for k, v in res['notifs'].items()
+            if k not in sent}
+        return res
+
+    def _write(self, entry):
+        with self.lock:
+            self.fd.write(f'{json.dumps(entry)}\n')
+            self.fd.flush()
+
+    def start(self, key, max_age):
+        """Starts a run, resuming the interrupted one if it has the same
+        urls key and started less than max_age seconds ago.
+
+        Returns the urls processed by the resumed run and the undelivered
+        notifications, which are kept in any case.
+        """
+        state = self.load()
+        if state['key'] == key and time.time() < state['ts'] + max_age:
+            start_ts, urls = state['ts'], state['urls']
+        else:
+            start_ts, urls = time.time(), set()
+        makedirs(os.path.dirname(self.file))
+        tmp_file = f'{self.file}.tmp'
+        with open(tmp_file, 'w') as fd:
+            for entry in [{'start': start_ts, 'key': key},
+                    {'urls': sorted(urls), 'notifs': state['notifs']}]:
+                fd.write(f'{json.dumps(entry)}\n')
+        os.replace(tmp_file, self.file)
+        self.fd = open(self.file, 'a')
+        return urls, state['notifs']
+
+    def add(self, url, notifs):
+        """Records the url as processed with its notifications, a list of
+        (title, body, key), and returns them by id.
+        """
+        res = {uuid4().hex: list(r) for r in notifs}
+        self._write({'urls': [url], 'notifs': res})
+        return res
+
+    def mark_sent(self, notif_ids):
+        self._write({'sent': notif_ids})
+
+    def close(self):
+        with self.lock:
+            if self.fd:
+                self.fd.close()
+                self.fd = None
+
+    def finish(self):
+        self.close()
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+
+class ShardStore:
+    """Coordinates collectors sharing the urls through a sqlite file.
+
+    Each collector holds leases on its share of the urls, renewed on
+    every run and expiring after SHARD_LEASE_DURATION, so the urls of a
+    collector which stopped running are taken over by the other ones.
+    Notifications are queued for the coordinator to deliver, and the
+    items are indexed across the collectors so an item found by several
+    of them is only notified once.
+    """
+
+    def __init__(self, file, worker_id):
+        self.file = file
+        self.worker_id = worker_id
+        makedirs(os.path.dirname(os.path.realpath(file)))
+        # No WAL, which requires shared memory, so the file can be on a
+        # network share
+        self.conn = sqlite3.connect(file, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat_ts INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                url TEXT PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_ts INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS notifications (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                body TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS items (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                first_seen INTEGER NOT NULL
+            );
+        """)
+
+    def _transaction(self, callback):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                res = callback()
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return res
+
+    def acquire(self, urls):
+        """Renews the leases of this collector and claims free urls up
+        to an equal share between the running collectors.
+
+        Returns the leased urls.
+        """
+        def callback():
+            now_ts = int(time.time())
+            min_ts = now_ts - SHARD_LEASE_DURATION
+            self.conn.execute('INSERT OR REPLACE INTO workers '
+                'VALUES (?, ?)', (self.worker_id, now_ts))
+            self.conn.execute('DELETE FROM workers WHERE heartbeat_ts < ?',
+                (min_ts,))
+            self.conn.execute('DELETE FROM leases WHERE expires_ts < ?',
+                (now_ts,))
+            self.conn.execute('DELETE FROM items WHERE first_seen < ?',
+                (now_ts - STORAGE_RETENTION_DELTA,))
+            worker_count = self.conn.execute(
+                'SELECT COUNT(*) FROM workers').fetchone()[0]
+            share = math.ceil(len(urls) / worker_count)
+            leases = dict(self.conn.execute(
+                'SELECT url, worker_id FROM leases').fetchall())
+            owned = [u for u in urls if leases.get(u) == self.worker_id]
+            free = [u for u in urls if u not in leases]
+            # Release the extra urls when other collectors joined
+            self.conn.executemany('DELETE FROM leases WHERE url = ?',
+                [(u,) for u in owned[share:]])
+            owned = set(owned[:share] + free[:max(share - len(owned), 0)])
+            self.conn.executemany('INSERT OR REPLACE INTO leases '
+                'VALUES (?, ?, ?)', [(u, self.worker_id,
+                    now_ts + SHARD_LEASE_DURATION) for u in owned])
+            return [u for u in urls if u in owned]
+
+        return self._transaction(callback)
+
+    def release(self, urls=None):
+        """Releases the leases on urls, or all the leases."""
+        def callback():
+            if urls is None:
+                self.conn.execute('DELETE FROM leases WHERE worker_id = ?',
+                    (self.worker_id,))
+                self.conn.execute('DELETE FROM workers WHERE worker_id = ?',
+                    (self.worker_id,))
+            else:
+                self.conn.executemany('DELETE FROM leases '
+                    'WHERE url = ? AND worker_id = ?',
+                    [(u, self.worker_id) for u in urls])
+
+        self._transaction(callback)
+
+    def index_items(self, url, keys):
+        """Indexes the item keys not indexed yet by any collector for url.
+
+        Returns the urls the keys were first seen at.
+        """
+        def callback():
+            now_ts = int(time.time())
+            self.conn.executemany('INSERT OR IGNORE INTO items '
+                'VALUES (?, ?, ?)', [(k, url, now_ts) for k in keys])
+            return {k: self.conn.execute('SELECT url FROM items '
+                'WHERE key = ?', (k,)).fetchone()[0] for k in keys}
+
+        return self._transaction(callback)
+
+    def add_notification(self, title, body):
+        self._transaction(lambda: self.conn.execute(
+            'INSERT INTO notifications (title, body) VALUES (?, ?)',
+            (title, body)))
+
+    def pop_notifications(self):
+        def callback():
+            res = self.conn.execute('SELECT id, title, body '
+                'FROM notifications ORDER BY id').fetchall()
+            if res:
+                self.conn.execute('DELETE FROM notifications WHERE id <= ?',
+                    (res[-1][0],))
+            return res
+
+        return self._transaction(callback)
+
+    def close(self):
+        self.conn.close()
+
+
+# Parser classes by id, see register_parser
+PARSERS = {}
+
+
+def import_webutils():
+    """Returns the webutils module shipped with itemz, with the browser
+    daemon and profile pool, rather than the webutils distribution.
+    """
+    if __package__:
+        from . import webutils
+    else:
+        import webutils
+    return webutils
+
+
+def register_parser(cls):
+    """Class decorator making a parser available to the collector."""
+    if cls.id in PARSERS:
+        raise Exception(f'parser {cls.id} is already registered')
+    PARSERS[cls.id] = cls
+    return cls
+
 
 class Parser:
     id = None
 
-    def __init__(self, headless=True):
+    def __init__(self, headless=True, isolated=False):
+        setup_logging()
         self.headless = headless
+        # Whether the parser may run alongside other parsers, so it must
+        # not share or kill their browser.
+        self.isolated = isolated
+        # Callable taking title and body, set by the collector
+        self.notify = None
+        self.breaker = CircuitBreaker(os.path.join(WORK_PATH, 'hosts.json'),
+            notify=self._notify)
+        # Conditional request validators by url, for parsers supporting
+        # them, e.g. {'etag': ..., 'last_modified': ...}.
+        self.validators = {}
+        # Parse durations by url, the fetch cost used for scheduling
+        self.durations = {}
+        # Callable returning the known names of a url among names,
+        # enables the incremental mode.
+        self.known_items = None
+        self.command_count = 0
+        self.start_ts = time.time()
+
+    def _notify(self, title, body):
+        if self.notify:
+            self.notify(title, body)
+
+    def _to_items(self, names):
+        items = {}
+        now_ts = int(time.time())
+        for index, name in enumerate(names):
+            items[name] = now_ts - index
+        return items
+
+    def _get_next_page_names(self):
+        return None
+
+    def _read_new_names(self, url, names):
+        """Reads newest first names until KNOWN_ITEMS_STOP consecutive
+        known ones, following next pages while they have new items.
+        """
+        res = []
+        for page in range(MAX_NEXT_PAGES + 1):
+            if page:
+                names = self._get_next_page_names()
+                if not names:
+                    break
+                logger.debug(f'parsed next page {page} of {url}')
+            known = self.known_items(url, names)
+            count = 0
+            for name in names:
+                res.append(name)
+                count = count + 1 if name in known else 0
+                if count >= KNOWN_ITEMS_STOP:
+                    return res
+            if not set(names) - known:
+                break
+        return res
+
+    def _get_items(self, url, names):
+        if self.known_items and KNOWN_ITEMS_STOP:
+            names = self._read_new_names(url, names)
+        return self._to_items(names)
 
     def parse(self, url):
+        """Returns the page items, or None if the page is known to be
+        unchanged since the last run.
+        """
         raise NotImplementedError()
 
+    def _get_skipped_result(self, url):
+        return url, None, SkippedUrlError(
+            f'skipped {url}, host is unavailable')
+
+    def iterate_items(self, urls):
+        """Yields (url, items, exception) tuples, in completion order."""
+        for url in urls:
+            if not self.breaker.allow(url):
+                yield self._get_skipped_result(url)
+                continue
+            logger.debug(f'parsing {url}')
+            command_count = self.command_count
+            start_ts = time.time()
+            with metrics.span('parse', parser=self.id, url=url) as span:
+                try:
+                    res = url, self.parse(url), None
+                    span['rows'] = len(res[1] or {})
+                except Exception as exc:
+                    res = url, None, exc
+                span['commands'] = self.command_count - command_count
+            self.durations[url] = time.time() - start_ts
+            self.breaker.record(url, success=res[2] is None)
+            yield res
+
     def quit(self):
-        pass
+        self.breaker.save()
+        metrics.add('parser', time.time() - self.start_ts, parser=self.id,
+            commands=self.command_count)
+
+
+class LoadTimeStore(JsonStore):
+    """Keeps recent page load times by url to adapt wait timeouts."""
+    max_count = 10
+
+    def get_timeout(self, url):
+        durations = self.data.get(url)
+        if not durations:
+            return MAX_WAIT_TIMEOUT
+        return min(max(max(durations) * WAIT_TIMEOUT_FACTOR,
+            MIN_WAIT_TIMEOUT), MAX_WAIT_TIMEOUT)
+
+    def add(self, url, duration):
+        durations = self.data.get(url, []) + [round(duration, 3)]
+        self.data[url] = durations[-self.max_count:]
+        self.updated.add(url)
 
 
 class BrowserParser(Parser):
-    def __init__(self, headless=True):
-        self.headless = headless
-        self.driver = get_browser_driver(browser_id=BROWSER_ID,
-            headless=headless, page_load_strategy='none')
+    row_xpath = None
+    name_xpath = None
+    next_page_xpath = None
+    # Xpaths of elements meaning the page is ready without rows, by name
+    marker_xpaths = {}
+    # Url patterns blocked in lean mode, in addition to the default ones
+    blocked_url_patterns = []
+    batch_extract = True
+
+    def __init__(self, headless=True, isolated=False, tabs=None):
+        super().__init__(headless=headless, isolated=isolated)
+        self.tabs = tabs or BROWSER_TABS
+        self.load_times = LoadTimeStore(os.path.join(WORK_PATH,
+            f'load-times-{self.id}.json'))
+        self.daemon = None
+        self.profile_pool = None
+        self.data_dir = None
+        # Set once the user logged in, to keep the profile cookies
+        self.update_profile = False
+        self.page_count = 0
+        self.transferred_bytes = 0
+        with metrics.span('driver_start', parser=self.id):
+            self.driver = self._get_driver()
+        self._count_commands()
+        self._setup_tab()
+        self.driver.set_script_timeout(MAX_WAIT_SLICE + 10)
+
+    def _get_driver(self):
+        # The browser stack is only imported once a browser parser is used
+        webutils = import_webutils()
+        browser_kwargs = {
+            'browser_id': BROWSER_ID,
+            'headless': self.headless,
+            'page_load_strategy': 'none',
+            'lean': self.lean,
+        }
+        if self.isolated or ISOLATED_BROWSER_PROFILES:
+            self.profile_pool = webutils.ProfilePool(os.path.join(WORK_PATH,
+                'browsers'), browser_id=BROWSER_ID)
+            self.data_dir = self.profile_pool.acquire()
+            return webutils.get_browser_driver(data_dir=self.data_dir,
+                kill_running=False, **browser_kwargs)
+        if BROWSER_DAEMON:
+            # One daemon per mode, so switching between lean and regular
+            # parsers doesn't restart the browser
+            suffix = '-lean' if self.lean else ''
+            # On the default data dir, the browser would hand off to the
+            # user's running one and ignore the remote debugging port
+            data_dir = webutils.ProfilePool(os.path.join(WORK_PATH,
+                'browsers'), browser_id=BROWSER_ID).get_shared(
+                f'daemon{suffix}')
+            self.daemon = webutils.BrowserDaemon(os.path.join(WORK_PATH,
+                    f'browser-daemon{suffix}.json'),
+                port=BROWSER_DAEMON_PORT + int(self.lean),
+                max_pages=BROWSER_DAEMON_MAX_PAGES,
+                max_rss=BROWSER_DAEMON_MAX_RSS, data_dir=data_dir,
+                **browser_kwargs)
+            try:
+                return self.daemon.get_driver()
+            except Exception:
+                logger.exception('failed to attach to the browser daemon')
+                self.daemon = None
+        return webutils.get_browser_driver(**browser_kwargs)
+
+    @property
+    def lean(self):
+        return self.id in LEAN_BROWSER_PARSERS
+
+    def _setup_tab(self):
+        if self.lean:
+            webutils = import_webutils()
+            webutils.block_urls(self.driver,
+                webutils.BLOCKED_URL_PATTERNS + self.blocked_url_patterns)
+
+    def _count_commands(self):
+        execute = self.driver.execute
+
+        def wrapper(*args, **kwargs):
+            self.command_count += 1
+            return execute(*args, **kwargs)
+
+        self.driver.execute = wrapper
+
+    def _get_name(self, text):
+        return text.strip()
+
+    def _find_names_legacy(self):
+        from selenium.webdriver.common.by import By
+
+        res = []
+        for el in self.driver.find_elements(By.XPATH, self.row_xpath):
+            els = el.find_elements(By.XPATH, self.name_xpath)
+            if els:
+                res.append(els[0].text)
+        return res
+
+    def _load(self, url):
+        with metrics.span('get', parser=self.id, url=url):
+            self.driver.get(url)
+        self.page_count += 1
+        start_ts = time.time()
+        return {
+            'url': url,
+            'start_ts': start_ts,
+            'end_ts': start_ts + self.load_times.get_timeout(url),
+            'ignored_markers': set(),
+        }
+
+    def _check_page(self, state, timeout):
+        """Returns the page state once rows or a marker are found or
+        after timeout seconds.
+        """
+        from selenium.common.exceptions import JavascriptException
+
+        markers = {k: v for k, v in self.marker_xpaths.items()
+            if k not in state['ignored_markers']}
+        try:
+            return self.driver.execute_async_script(WAIT_PAGE_SCRIPT,
+                self.row_xpath, self.name_xpath, markers,
+                int(timeout * 1000))
+        except JavascriptException:
+            # The document was unloaded while waiting
+            logger.debug(f'failed to check {state["url"]}', exc_info=True)
+            time.sleep(.1)
+            return None
+
+    def _handle_marker(self, state, marker):
+        """Returns the page names for the marker, None if the page is
+        not ready yet.
+        """
+        raise NotImplementedError()
+
+    def _read_page_names(self, state, res):
+        expired = time.time() >= state['end_ts']
+        if res and res['texts']:
+            if res['loading'] and not expired:
+                return None
+            with metrics.span('extract', parser=self.id,
+                    url=state['url']) as span:
+                texts = self._find_names_legacy() \
+                    if not self.batch_extract else res['texts']
+                names = [self._get_name(r) for r in texts if r is not None]
+                span['rows'] = len(names)
+            if names:
+                return names
+        if res and res['marker']:
+            names = self._handle_marker(state, res['marker'])
+            if names is not None:
+                return names
+        if expired:
+            raise Exception('timeout')
+        return None
+
+    def _get_page_names(self, state, res):
+        names = self._read_page_names(state, res)
+        if names is not None:
+            duration = time.time() - state['start_ts']
+            if not state.get('skip_load_time'):
+                self.load_times.add(state['url'], duration)
+            metrics.add('wait', duration, parser=self.id, url=state['url'],
+                rows=len(names))
+            transferred = res.get('transferred') or 0
+            self.transferred_bytes += transferred
+            logger.debug(f'loaded {state["url"]} in {duration:.02f} seconds '
+                f'({transferred // 1024} KB transferred)')
+        return names
+
+    def _poll_names(self, state):
+        """Returns the page names once it is ready, None otherwise."""
+        return self._get_page_names(state, self._check_page(state, 0))
+
+    def _wait_for_names(self, url):
+        state = self._load(url)
+        while True:
+            timeout = min(max(state['end_ts'] - time.time(), 0),
+                MAX_WAIT_SLICE)
+            names = self._get_page_names(state,
+                self._check_page(state, timeout))
+            if names is not None:
+                return names
+
+    def parse(self, url):
+        return self._get_items(url, self._wait_for_names(url))
+
+    def _get_next_page_names(self):
+        if not self.next_page_xpath:
+            return None
+        url = self.driver.execute_script(NEXT_PAGE_URL_SCRIPT,
+            self.next_page_xpath)
+        return self._wait_for_names(url) if url else None
+
+    def _get_tab_handles(self, count):
+        while len(self.driver.window_handles) < count:
+            self.driver.switch_to.new_window('tab')
+            self._setup_tab()
+        return self.driver.window_handles[:count]
+
+    def _poll_tab(self, handle, state):
+        self.driver.switch_to.window(handle)
+        try:
+            names = self._poll_names(state)
+            if names is None:
+                return None
+            return state['url'], self._get_items(state['url'], names), None
+        except Exception as exc:
+            return state['url'], None, exc
+
+    def iterate_items(self, urls, poll_frequency=.5):
+        """Starts loading up to `tabs` urls at once and yields each one
+        as soon as its page is ready.
+        """
+        if self.tabs < 2 or len(urls) < 2:
+            yield from super().iterate_items(urls)
+            return
+        pending = list(urls)
+        # Urls of a host being probed wait for the probe result
+        deferred = []
+        free_handles = self._get_tab_handles(min(self.tabs, len(urls)))
+        states = {}
+        while pending or states or deferred:
+            pending += [r for r in deferred
+                if not self.breaker.is_probing(r)]
+            deferred = [r for r in deferred if self.breaker.is_probing(r)]
+            while pending and free_handles:
+                url = pending.pop(0)
+                if self.breaker.is_probing(url):
+                    deferred.append(url)
+                    continue
+                if not self.breaker.allow(url):
+                    yield self._get_skipped_result(url)
+                    continue
+                handle = free_handles.pop(0)
+                logger.debug(f'parsing {url}')
+                self.driver.switch_to.window(handle)
+                try:
+                    states[handle] = self._load(url)
+                except Exception as exc:
+                    free_handles.append(handle)
+                    self.breaker.record(url, success=False)
+                    yield url, None, exc
+            ready = False
+            for handle, state in list(states.items()):
+                res = self._poll_tab(handle, state)
+                if res is None:
+                    continue
+                del states[handle]
+                free_handles.append(handle)
+                ready = True
+                duration = time.time() - state['start_ts']
+                self.durations[res[0]] = duration
+                metrics.add('parse', duration, parser=self.id, url=res[0],
+                    rows=len(res[1] or {}))
+                self.breaker.record(res[0], success=res[2] is None)
+                yield res
+            if not ready:
+                time.sleep(poll_frequency)
+
+    def _release_daemon(self):
+        """Leaves the daemon browser with a single blank tab."""
+        self.daemon.add_pages(self.page_count)
+        handles = self.driver.window_handles
+        for handle in handles[1:]:
+            self.driver.switch_to.window(handle)
+            self.driver.close()
+        self.driver.switch_to.window(handles[0])
+        self.driver.get('about:blank')
 
     def quit(self):
+        super().quit()
+        self.load_times.save()
+        logger.info(f'{self.id} loaded {self.page_count} pages '
+            f'({self.transferred_bytes // 1024} KB transferred)')
+        if self.daemon:
+            try:
+                self._release_daemon()
+            except Exception:
+                logger.exception('failed to release the browser daemon')
         self.driver.quit()
+        if self.profile_pool:
+            self.profile_pool.release(self.data_dir,
+                update_template=self.update_profile)
 
 
+@register_parser
 class X1337xParser(BrowserParser):
     id = '1337x'
+    row_xpath = '//table/tbody/tr'
+    name_xpath = './/td'
+    next_page_xpath = '//div[contains(@class, "pagination")]//a[text()=">>"]'
+    marker_xpaths = {
+        'no_results': '//p[contains(text(), "No results were returned.")]',
+    }
 
-    def _has_no_results(self):
-        try:
-            return bool(self.driver.find_element(By.XPATH,
-                '//p[contains(text(), "No results were returned.")]'))
-        except NoSuchElementException:
-            return False
-
-    def _wait_for_elements(self, url, poll_frequency=.5, timeout=10):
-        self.driver.get(url)
-        end_ts = time.time() + timeout
-        while time.time() < end_ts:
-            try:
-                els = self.driver.find_elements(By.XPATH, '//table/tbody/tr')
-                if not els:
-                    raise NoSuchElementException()
-                return els
-            except NoSuchElementException:
-                if self._has_no_results():
-                    logger.debug('no result')
-                    return []
-                time.sleep(poll_frequency)
-        raise Exception('timeout')
+    def _handle_marker(self, state, marker):
+        logger.debug('no result')
+        return []
 
     def _get_name(self, text):
         return text.splitlines()[0].strip()
 
-    def parse(self, url):
-        items = {}
-        now_ts = int(time.time())
-        for index, el in enumerate(self._wait_for_elements(url)):
-            tds = el.find_elements(By.XPATH, './/td')
-            items[self._get_name(tds[0].text)] = now_ts - index
-        return items
-
 
+@register_parser
 class RutrackerParser(BrowserParser):
     id = 'rutracker'
+    row_xpath = '//div[contains(@class, "t-title")]'
+    name_xpath = './/a'
+    next_page_xpath = '//a[@class="pg" and text()="След."]'
+    marker_xpaths = {
+        'login': '//input[@type="submit" and @name="login"]',
+    }
+
+    def _handle_marker(self, state, marker):
+        if self.headless:
+            raise Exception('requires login')
+        logger.info('waiting for user login...')
+        self.update_profile = True
+        state['ignored_markers'].add(marker)
+        state['skip_load_time'] = True
+        state['end_ts'] += 120
+        return None
+
+
+class XPathStep:
+    def __init__(self, descendant, tag, class_name=None):
+        self.descendant = descendant
+        self.tag = tag
+        self.class_name = class_name
+
+    def match(self, element):
+        tag, classes = element
+        return self.tag in ('*', tag) \
+            and (not self.class_name or self.class_name in classes)
+
+
+def parse_xpath(xpath):
+    """Parses the simple xpath subset used by parsers, e.g.
+    '//table/tbody/tr' or './/div[contains(@class, "t-title")]'.
+    """
+    steps = []
+    pattern = re.compile(r'(//|/)([\w*]+)'
+        r'(?:\[contains\(@class,\s*["\']([^"\']+)["\']\)\])?')
+    pos = 1 if xpath.startswith('.') else 0
+    while pos < len(xpath):
+        res = pattern.match(xpath, pos)
+        if not res:
+            raise Exception(f'unsupported xpath {xpath}')
+        steps.append(XPathStep(descendant=res.group(1) == '//',
+            tag=res.group(2), class_name=res.group(3)))
+        pos = res.end()
+    return steps
+
+
+def match_xpath(steps, path):
+    """Whether the last element of path, a list of (tag, classes) from
+    the context node down, matches steps.
+    """
+    if not path or not steps[-1].match(path[-1]):
+        return False
+    if len(steps) == 1:
+        return steps[0].descendant or len(path) == 1
+    if steps[-1].descendant:
+        return any(match_xpath(steps[:-1], path[:i])
+            for i in range(len(path) - 1, 0, -1))
+    return match_xpath(steps[:-1], path[:-1])
+
+
+class RowTextExtractor(HTMLParser):
+    """Streaming equivalent of the WAIT_PAGE_SCRIPT row extraction.
+
+    Like the browser innerText, lines only break around block elements:
+    the block tags by default and the block_classes elements, laid out as
+    blocks by the site stylesheet (e.g. floats).
+    """
+    void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+        'link', 'meta', 'source', 'track', 'wbr'}
+    block_tags = {'address', 'article', 'aside', 'blockquote', 'br',
+        'caption', 'center', 'dd', 'details', 'dialog', 'div', 'dl', 'dt',
+        'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+        'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'legend', 'li',
+        'main', 'menu', 'nav', 'ol', 'p', 'pre', 'section', 'summary',
+        'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul'}
+
+    def __init__(self, row_xpath, name_xpath, block_classes=None):
+        super().__init__(convert_charrefs=True)
+        self.row_steps = parse_xpath(row_xpath)
+        self.name_steps = parse_xpath(name_xpath)
+        self.block_classes = set(block_classes or [])
+        self.stack = []
+        self.row_depth = None
+        self.name_depth = None
+        self.name_chunks = None
+        self.texts = []
+
+    def _break_line(self, tag, classes):
+        if self.name_depth is not None and (tag in self.block_tags
+                or self.block_classes.intersection(classes)):
+            self.name_chunks.append('\n')
+
+    def handle_starttag(self, tag, attrs):
+        classes = (dict(attrs).get('class') or '').split()
+        self._break_line(tag, classes)
+        if tag in self.void_tags:
+            return
+        self.stack.append((tag, classes))
+        if self.row_depth is None:
+            if match_xpath(self.row_steps, self.stack):
+                self.row_depth = len(self.stack)
+                self.name_chunks = None
+        elif self.name_chunks is None and match_xpath(self.name_steps,
+                self.stack[self.row_depth:]):
+            self.name_depth = len(self.stack)
+            self.name_chunks = []
+
+    def handle_endtag(self, tag):
+        tags = [r[0] for r in self.stack]
+        if tag not in tags:
+            self._break_line(tag, [])
+            return
+        depth = len(tags) - tags[::-1].index(tag) - 1
+        self._break_line(tag, self.stack[depth][1])
+        del self.stack[depth:]
+        if self.name_depth is not None and depth < self.name_depth:
+            self.name_depth = None
+        if self.row_depth is not None and depth < self.row_depth:
+            self.row_depth = None
+            self.texts.append(self._get_text(self.name_chunks))
+
+    def handle_data(self, data):
+        if self.name_depth is not None:
+            self.name_chunks.append(re.sub(r'\s+', ' ', data))
 
-    def _requires_login(self):
+    def _get_text(self, chunks):
+        if chunks is None:
+            return None
+        lines = [r.strip() for r in ''.join(chunks).splitlines()]
+        return '\n'.join(r for r in lines if r)
+
+
+class HttpParser(Parser):
+    """Fetches static listings without a browser and falls back to
+    fallback_cls on challenge pages or when no row is found.
+    """
+    row_xpath = None
+    name_xpath = None
+    no_results_text = None
+    # Classes of the elements styled as blocks, which break lines
+    block_classes = []
+    challenge_texts = ['challenge-platform', 'cf-chl-', 'Just a moment...',
+        'Attention Required!']
+    fallback_cls = None
+
+    def __init__(self, headless=True, isolated=False):
+        super().__init__(headless=headless, isolated=isolated)
+        import urllib3
+
+        self.http = urllib3.PoolManager(headers={
+            'User-Agent': HTTP_USER_AGENT}, retries=False,
+            timeout=HTTP_TIMEOUT)
+        self.fallback = None
+
+    def _get_name(self, text):
+        return text.strip()
+
+    def _get_conditional_headers(self, url):
+        validators = self.validators.get(url) or {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def _set_validators(self, url, headers):
+        validators = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        if any(validators.values()):
+            self.validators[url] = validators
+        else:
+            self.validators.pop(url, None)
+
+    def _fetch(self, url, extractor):
+        with metrics.span('get', parser=self.id, url=url):
+            response = self.http.request('GET', url, preload_content=False,
+                headers=self._get_conditional_headers(url))
         try:
-            return bool(self.driver.find_element(By.XPATH,
-                '//input[@type="submit" and @name="login"]'))
-        except NoSuchElementException:
-            return False
+            with metrics.span('extract', parser=self.id, url=url) as span:
+                decoder = codecs.getincrementaldecoder('utf-8')(
+                    errors='replace')
+                chunks = []
+                for chunk in response.stream(64 * 1024):
+                    text = decoder.decode(chunk)
+                    chunks.append(text)
+                    extractor.feed(text)
+                extractor.feed(decoder.decode(b'', final=True))
+                extractor.close()
+                span['rows'] = len(extractor.texts)
+            return response.status, response.headers, ''.join(chunks)
+        finally:
+            response.release_conn()
 
-    def _wait_for_elements(self, url, poll_frequency=.5, timeout=10):
-        self.driver.get(url)
-        end_ts = time.time() + timeout
-        wait_for_login = False
-        while time.time() < end_ts:
-            try:
-                els = self.driver.find_elements(By.XPATH,
-                    '//div[contains(@class, "t-title")]')
-                if not els:
-                    raise NoSuchElementException()
-                return els
-            except NoSuchElementException:
-                if self._requires_login() and not wait_for_login:
-                    if self.headless:
-                        raise Exception('requires login')
-                    logger.info('waiting for user login...')
-                    wait_for_login = True
-                    end_ts += 120
-                time.sleep(poll_frequency)
-        raise Exception('timeout')
+    def _get_names(self, url, status, html, extractor):
+        """Returns the page names, or None if the page must be loaded
+        in a browser.
+        """
+        if status != 200:
+            logger.debug(f'got status {status} from {url}')
+            return None
+        if any(r in html for r in self.challenge_texts):
+            logger.debug(f'got challenge page from {url}')
+            return None
+        names = [self._get_name(r) for r in extractor.texts if r]
+        if not names and not (self.no_results_text
+                and self.no_results_text in html):
+            logger.debug(f'found no row in {url}')
+            return None
+        return names
+
+    def _get_fallback(self):
+        if not self.fallback:
+            self.fallback = self.fallback_cls(headless=self.headless,
+                isolated=self.isolated)
+            self.fallback.known_items = self.known_items
+            self.fallback.notify = self.notify
+        return self.fallback
 
     def parse(self, url):
-        items = {}
-        now_ts = int(time.time())
-        for index, el in enumerate(self._wait_for_elements(url)):
-            link = el.find_element(By.XPATH, './/a')
-            name = link.text.strip()
-            items[name] = now_ts - index
-        return items
+        extractor = RowTextExtractor(self.row_xpath, self.name_xpath,
+            self.block_classes)
+        status, headers, html = self._fetch(url, extractor)
+        if status == 304:
+            logger.debug(f'{url} is not modified')
+            return None
+        names = self._get_names(url, status, html, extractor)
+        if names is None:
+            self.validators.pop(url, None)
+            if not self.fallback_cls:
+                raise Exception('failed to parse page')
+            logger.info(f'falling back to {self.fallback_cls.__name__} '
+                f'for {url}')
+            return self._get_fallback().parse(url)
+        self._set_validators(url, headers)
+        return self._get_items(url, names)
+
+    def quit(self):
+        super().quit()
+        self.http.clear()
+        if self.fallback:
+            self.fallback.quit()
+
+
+@register_parser
+class X1337xHttpParser(HttpParser):
+    id = '1337x_http'
+    row_xpath = X1337xParser.row_xpath
+    name_xpath = X1337xParser.name_xpath
+    no_results_text = 'No results were returned.'
+    # The floated comment count
+    block_classes = ['comments']
+    fallback_cls = X1337xParser
+    _get_name = X1337xParser._get_name
+
+
+def _parse_worker(worker_id, parser_cls, urls, headless,
+        validators, known_items, result_queue):
+    parser = None
+    # Drops the spans inherited from the collector process
+    metrics.reset()
+    reset_storage_locks()
+    try:
+        parser = parser_cls(headless=headless, isolated=True)
+        parser.validators.update(validators)
+        parser.known_items = known_items
+        parser.notify = lambda title, body: result_queue.put({
+            'worker_id': worker_id,
+            'notification': [title, body],
+        })
+        for url, items, exc in parser.iterate_items(urls):
+            result_queue.put({
+                'worker_id': worker_id,
+                'parser_id': parser_cls.id,
+                'url': url,
+                'items': items,
+                'validators': parser.validators.get(url),
+                'error': str(exc) if exc else None,
+                'skipped': isinstance(exc, SkippedUrlError),
+                'traceback': ''.join(traceback.format_exception(exc))
+                    if exc else None,
+                'duration': parser.durations.get(url),
+            })
+    except Exception as exc:
+        result_queue.put({
+            'worker_id': worker_id,
+            'parser_id': parser_cls.id,
+            'url': None,
+            'error': str(exc),
+            'traceback': traceback.format_exc(),
+        })
+    finally:
+        if parser:
+            parser.quit()
+        result_queue.put({'worker_id': worker_id, 'done': True,
+            'spans': metrics.pop_spans()})
+
+
+class Stage:
+    """Runs handler on the items of a bounded queue in a thread, so
+    producers block when it lags behind.
+    """
+    stop = object()
+
+    def __init__(self, name, handler, maxsize):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._run, name=name,
+            daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            if args is self.stop:
+                return
+            try:
+                self.handler(*args)
+            except Exception:
+                logger.exception(f'failed to run {self.name} stage')
+
+    def put(self, *args):
+        self.queue.put(args)
+
+    def close(self):
+        """Waits for the queued items to be processed."""
+        self.queue.put(self.stop)
+        self.thread.join()
+
+
+class NotificationDispatcher:
+    """Delivers notifications from a thread, coalescing the messages
+    sent within NOTIF_WINDOW seconds by key (the title by default), and
+    across keys above NOTIF_MAX_PER_WINDOW messages, with at least
+    NOTIF_MIN_INTERVAL seconds between deliveries.
+
+    sink is a callable taking title and body. Journaled notifications
+    are marked as delivered in the journal before being sent.
+    """
+
+    def __init__(self, sink, journal=None):
+        self.sink = sink
+        self.journal = journal
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.last_ts = 0
+        self.thread = threading.Thread(target=self._run, name='notify',
+            daemon=True)
+        self.thread.start()
+
+    def send(self, title, body, key=None, notif_id=None):
+        with self.lock:
+            _, bodies, notif_ids = self.pending.setdefault(key or title,
+                (title, [], []))
+            bodies.append(body)
+            if notif_id:
+                notif_ids.append(notif_id)
+
+    def _join(self, bodies):
+        body = '\n'.join(bodies)
+        if len(body) > MAX_NOTIF_BODY_SIZE:
+            body = f'{body[:MAX_NOTIF_BODY_SIZE]}...'
+        return body
+
+    def _pop_messages(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        messages = [(t, self._join(b), i) for t, b, i in pending.values()]
+        if len(messages) > NOTIF_MAX_PER_WINDOW:
+            index = NOTIF_MAX_PER_WINDOW - 1
+            messages = messages[:index] + [(NAME, self._join(
+                [f'{t}: {b}' for t, b, _ in messages[index:]]),
+                [r for _, _, i in messages[index:] for r in i])]
+        return messages
+
+    def _deliver(self, title, body, notif_ids):
+        delay = self.last_ts + NOTIF_MIN_INTERVAL - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            if notif_ids and self.journal:
+                self.journal.mark_sent(notif_ids)
+            with metrics.span('notify'):
+                self.sink(title, body)
+        except Exception:
+            logger.exception(f'failed to send notification {title}')
+        self.last_ts = time.time()
+
+    def _run(self):
+        while not self.closing.wait(NOTIF_WINDOW):
+            for message in self._pop_messages():
+                self._deliver(*message)
+
+    def close(self):
+        """Delivers the pending messages and stops the thread."""
+        self.closing.set()
+        self.thread.join()
+        for message in self._pop_messages():
+            self._deliver(*message)
 
 
 class ItemCollector:
-    def __init__(self, config, headless=True):
+    def __init__(self, config, headless=True, notification_sink=None):
+        setup_logging()
         self.config = config
         self.storage_path = self.config.ITEM_STORAGE_PATH or ITEM_STORAGE_PATH
         self.headless = headless
-        self.parsers = self._list_parsers()
-
-    def _list_parsers(self):
-        res = {}
-        module = sys.modules[__name__]
-        for name, obj in inspect.getmembers(module, inspect.isclass):
-            if obj.__module__ == module.__name__ \
-                    and issubclass(obj, Parser) and obj.id:
-                res[obj.id] = obj
-        return res
+        self.storage_cls = STORAGE_CLASSES[STORAGE_BACKEND]
+        self.fingerprints = FingerprintStore(self.storage_path)
+        self.known_items = KnownItems(self.storage_cls, self.storage_path)
+        self.item_index = ItemIndex(self.storage_path)
+        self.schedule = UrlSchedule(os.path.join(WORK_PATH, 'schedule.json'))
+        self.urls = {}
+        self.journal = RunJournal(os.path.join(WORK_PATH, 'journal.jsonl'))
+        self.shard_store = None
+        self.unchanged_count = 0
+        self.notification_sink = notification_sink \
+            or self._send_notification
+        self.storage_stage = None
+        self.dispatcher = None
+        self.parsers = dict(PARSERS)
+
+    def _get_url_gen(self, parser_id):
+        return URLIdGenerator.load(os.path.join(WORK_PATH, 'url-ids.json'),
+            self.config.URLS[parser_id])
+
+    def _send_notification(self, title, body):
+        Notifier().send(title=title, body=body)
 
-    def _notify_new_items(self, url_id, items):
+    def _notify(self, title, body, key=None):
+        if self.dispatcher:
+            self.dispatcher.send(title, body, key=key)
+        else:
+            self.notification_sink(title, body)
+
+    def _get_item_notifications(self, url_id, items):
         title = f'{NAME} {url_id}'
-        names = [clean_item(n) for n, _ in sorted(items.items(),
-            key=lambda x: x[1])]
+        names = clean_items(n for n, _ in sorted(items.items(),
+            key=lambda x: x[1]))
         max_latest = MAX_NOTIF_PER_URL - 1
         latest_names = names[-max_latest:]
         older_names = names[:-max_latest]
+        res = []
         if older_names:
             body = ', '.join(reversed(older_names))
             if len(body) > MAX_NOTIF_BODY_SIZE:
                 body = f'{body[:MAX_NOTIF_BODY_SIZE]}...'
-            Notifier().send(title=title, body=f'{body}')
-        for name in latest_names:
-            Notifier().send(title=title, body=name)
+            res.append((title, body))
+        return res + [(title, r) for r in latest_names]
 
-    def _parse_url(self, parser, url, url_gen):
-        item_storage = ItemStorage(self.storage_path, url)
-        all_items = parser.parse(url)
+    def _process_items(self, parser_id, url, all_items, url_gen,
+            validators=None):
+        """Returns the number of new items and the notifications to send
+        once they are stored.
+        """
+        if all_items is None:
+            logger.debug(f'skipped unchanged {url}')
+            self.unchanged_count += 1
+            return 0, []
+        fingerprint = self.fingerprints.get_fingerprint(all_items)
+        if fingerprint == self.fingerprints.get(url).get('fingerprint'):
+            logger.debug(f'skipped unchanged {url}')
+            self.unchanged_count += 1
+            self.fingerprints.set(url, fingerprint, validators)
+            return 0, []
+        fields = {'parser': parser_id, 'url': url}
+        with metrics.span('storage_load', **fields):
+            item_storage = self.storage_cls(self.storage_path, url)
         logger.info(f'parsed {len(all_items)} items from {url}')
-        new_items = {k: v for k, v in all_items.items()
-            if k not in item_storage.items}
+        with metrics.span('diff', rows=len(all_items), **fields):
+            new_items = item_storage.get_new_items(all_items)
+        notifs = []
         if new_items:
             logger.info(f'new items from {url}:\n'
                 f'{to_json(sorted(new_items.keys()))}')
-            url_id = url_gen.shorten(url) or parser.id
-            self._notify_new_items(url_id, new_items)
-            item_storage.save(all_items, new_items)
+            # Items first seen at another url are only stored.
+            seen = self.item_index.add(url, new_items)
+            if seen:
+                logger.info(f'skipped {len(seen)} items already seen '
+                    f'at other urls')
+            to_notify = {k: v for k, v in new_items.items() if k not in seen}
+            if to_notify:
+                url_id = url_gen.shorten(url) or parser_id
+                notifs = self._get_item_notifications(url_id, to_notify)
+            with metrics.span('save', rows=len(new_items), **fields):
+                item_storage.save(all_items, new_items)
+        self.fingerprints.set(url, fingerprint, validators)
+        return len(new_items), notifs
+
+    def _store_items(self, parser_id, url, all_items, url_gen, validators):
+        try:
+            new_count, notifs = self._process_items(parser_id, url,
+                all_items, url_gen, validators)
+            self.schedule.record_run(url, new_count)
+            # Journaled with the url, so they are neither lost nor sent
+            # again by a resumed run
+            notifs = self.journal.add(url, [(t, b, url) for t, b in notifs])
+            for notif_id, (title, body, key) in notifs.items():
+                self.dispatcher.send(title, body, key=key, notif_id=notif_id)
+        except Exception as exc:
+            logger.exception(f'failed to process {url}')
+            self._notify(f'{NAME} error', f'failed to process {url}: {exc}')
 
     def _parse_urls(self, parser_id, urls):
         parser = self.parsers[parser_id](headless=self.headless)
         try:
-            url_gen = URLIdGenerator(urls)
-            for url in urls:
-                logger.debug(f'parsing {url}')
+            url_gen = self._get_url_gen(parser_id)
+            parser.validators.update(self.fingerprints.get_validators(urls))
+            parser.known_items = self.known_items
+            parser.notify = self._notify
+            for url, all_items, exc in parser.iterate_items(urls):
+                self.schedule.record_duration(url, parser.durations.get(url))
                 try:
-                    self._parse_url(parser, url, url_gen)
+                    if exc:
+                        raise exc
+                    self.storage_stage.put(parser.id, url, all_items,
+                        url_gen, parser.validators.get(url))
+                except SkippedUrlError as exc:
+                    logger.info(str(exc))
                 except Exception as exc:
                     logger.exception(f'failed to process {url}')
-                    Notifier().send(title=f'{NAME} error',
-                        body=f'failed to process {url}: {exc}')
+                    self._notify(f'{NAME} error',
+                        f'failed to process {url}: {exc}')
         finally:
             parser.quit()
 
+    def _iterate_worker_tasks(self):
+        for parser_id, urls in self.urls.items():
+            if not urls:
+                continue
+            size = URLS_PER_WORKER or len(urls)
+            for i in range(0, len(urls), size):
+                yield parser_id, urls[i:i + size]
+
+    def _handle_worker_result(self, result, url_gens):
+        parser_id = result['parser_id']
+        url = result['url']
+        if not url:
+            logger.error(f'failed to process {parser_id}:\n'
+                f'{result["traceback"]}')
+            self._notify(NAME, f'failed to process {parser_id}')
+            return
+        if result['skipped']:
+            logger.info(result['error'])
+            return
+        if result['error']:
+            logger.error(f'failed to process {url}:\n{result["traceback"]}')
+            self._notify(f'{NAME} error',
+                f'failed to process {url}: {result["error"]}')
+            return
+        logger.debug(f'parsed {url} in {result["duration"]:.02f} seconds')
+        self.schedule.record_duration(url, result['duration'])
+        self.storage_stage.put(parser_id, url, result['items'],
+            url_gens[parser_id], result['validators'])
+
+    def _run_workers(self):
+        """Runs parsers in worker processes, each with its own browser,
+        and processes their results as they come.
+        """
+        url_gens = {k: self._get_url_gen(k) for k in self.config.URLS}
+        tasks = list(self._iterate_worker_tasks())
+        result_queue = multiprocessing.Queue()
+        # Ids are not reused, so late results of a terminated worker are
+        # ignored
+        worker_ids = count()
+        workers = {}
+        while tasks or workers:
+            while tasks and len(workers) < PARSER_WORKERS:
+                worker_id = next(worker_ids)
+                parser_id, urls = tasks.pop(0)
+                process = multiprocessing.Process(target=_parse_worker,
+                    args=(worker_id, self.parsers[parser_id], urls,
+                        self.headless, self.fingerprints.get_validators(urls),
+                        self.known_items, result_queue))
+                process.start()
+                workers[worker_id] = {
+                    'parser_id': parser_id,
+                    'process': process,
+                    'urls': set(urls),
+                    'end_ts': time.time() + WORKER_URL_TIMEOUT * len(urls),
+                }
+            self._check_workers(workers)
+            try:
+                result = result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            worker = workers.get(result['worker_id'])
+            if not worker:
+                continue
+            if result.get('done'):
+                metrics.extend(result['spans'])
+                del workers[result['worker_id']]
+                worker['process'].join()
+            elif result.get('notification'):
+                self._notify(*result['notification'])
+            else:
+                worker['urls'].discard(result['url'])
+                self._handle_worker_result(result, url_gens)
+
+    def _check_workers(self, workers):
+        """Removes the workers which crashed or timed out."""
+        for worker_id, worker in list(workers.items()):
+            parser_id, process = worker['parser_id'], worker['process']
+            if time.time() > worker['end_ts']:
+                process.terminate()
+                process.join()
+                del workers[worker_id]
+                urls = sorted(worker['urls'])
+                logger.error(f'worker {worker_id} for {parser_id} timed out '
+                    f'with {len(urls)} unprocessed urls: {urls}')
+                self._notify(NAME, f'failed to process {parser_id}: '
+                    f'timed out with {len(urls)} unprocessed urls')
+            # A clean exit means its done message is still in flight
+            elif not process.is_alive() and process.exitcode != 0:
+                del workers[worker_id]
+                logger.error(f'worker {worker_id} for {parser_id} '
+                    f'exited with code {process.exitcode}')
+                self._notify(NAME, f'failed to process {parser_id}')
+
     def run(self):
         start_ts = time.time()
         all_urls = set()
-        for parser_id, urls in self.config.URLS.items():
+        for urls in self.config.URLS.values():
             all_urls.update(set(urls))
-            try:
-                self._parse_urls(parser_id, urls)
-            except Exception:
-                logger.exception(f'failed to process {parser_id}')
-                Notifier().send(title=f'{NAME}',
-                    body=f'failed to process {parser_id}')
-        ItemStorage.cleanup(self.storage_path, all_urls)
-        logger.info(f'processed in {time.time() - start_ts:.02f} seconds')
+        self.urls = self.config.URLS
+        sink = self.notification_sink
+        if SHARD_STORE_PATH:
+            self.shard_store = ShardStore(SHARD_STORE_PATH,
+                SHARD_WORKER_ID or socket.gethostname())
+            leased = set(self.shard_store.acquire(list(dict.fromkeys(
+                u for v in self.urls.values() for u in v))))
+            logger.info(f'leased {len(leased)}/{len(all_urls)} urls')
+            self.urls = {k: [u for u in v if u in leased]
+                for k, v in self.urls.items()}
+            self.item_index.shard_store = self.shard_store
+            if not SHARD_COORDINATOR:
+                sink = self.shard_store.add_notification
+        if ADAPTIVE_SCHEDULE:
+            self.urls = self.schedule.get_due_urls(self.urls)
+            due_count = sum(len(v) for v in self.urls.values())
+            logger.info(f'{due_count}/{len(all_urls)} urls are due')
+        urls_key = hashlib.md5(to_json(self.config.URLS).encode(
+            'utf-8')).hexdigest()
+        done_urls, notifs = self.journal.start(urls_key, RUN_RESUME_MAX_AGE)
+        if done_urls:
+            logger.info(f'resuming the interrupted run, skipping '
+                f'{len(done_urls)} processed urls')
+            self.urls = {k: [u for u in v if u not in done_urls]
+                for k, v in self.urls.items()}
+        # Storage and notifications run in their own threads while the
+        # next urls are fetched.
+        self.dispatcher = NotificationDispatcher(sink, journal=self.journal)
+        if notifs:
+            logger.info(f'replaying {len(notifs)} undelivered notifications')
+        for notif_id, (title, body, key) in notifs.items():
+            self.dispatcher.send(title, body, key=key, notif_id=notif_id)
+        self.storage_stage = Stage('storage', self._store_items,
+            maxsize=PIPELINE_QUEUE_SIZE)
+        try:
+            if PARSER_WORKERS:
+                self._run_workers()
+            else:
+                for parser_id, urls in self.urls.items():
+                    if not urls:
+                        continue
+                    try:
+                        self._parse_urls(parser_id, urls)
+                    except Exception:
+                        logger.exception(f'failed to process {parser_id}')
+                        self._notify(NAME, f'failed to process {parser_id}')
+        finally:
+            self.storage_stage.close()
+            if self.shard_store and SHARD_COORDINATOR:
+                # Already coalesced by the other collectors
+                for notif_id, title, body in \
+                        self.shard_store.pop_notifications():
+                    self._notify(title, body, key=f'shard {notif_id}')
+            self.dispatcher.close()
+            self.journal.close()
+            if self.shard_store:
+                self.shard_store.close()
+            self.item_index.shard_store = None
+            self.storage_stage = self.dispatcher = self.shard_store = None
+        self.fingerprints.save(all_urls)
+        self.item_index.save(all_urls)
+        self.schedule.save(all_urls)
+        if not SHARD_STORE_PATH or SHARD_COORDINATOR:
+            self.storage_cls.cleanup(self.storage_path, all_urls)
+        self.journal.finish()
+        duration = time.time() - start_ts
+        metrics.save({
+            'run_seconds': duration,
+            'last_run_timestamp_seconds': int(start_ts),
+            'urls': len(all_urls),
+            'unchanged_urls': self.unchanged_count,
+        })
+        logger.info(f'processed in {duration:.02f} seconds '
+            f'({self.unchanged_count}/{len(all_urls)} unchanged urls)')
+
 
+def collect_items(config, profile=False):
+    if not profile:
+        ItemCollector(config).run()
+        return
+    import cProfile
+    import pstats
 
-def collect_items(config):
-    ItemCollector(config).run()
+    profiler = cProfile.Profile()
+    profiler.runcall(ItemCollector(config).run)
+    file = os.path.join(WORK_PATH, f'{NAME}.prof')
+    profiler.dump_stats(file)
+    stats = pstats.Stats(file, stream=sys.stdout)
+    stats.sort_stats('cumulative').print_stats(30)
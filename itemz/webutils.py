@@ -1,9 +1,22 @@
+from contextlib import contextmanager
+from glob import glob
+import json
 import os
+import shutil
 import subprocess
+import time
+import urllib.request
+from uuid import uuid4
 
+import psutil
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 BROWSER_CONFIGS = {
     'nt': {
@@ -37,16 +50,43 @@ BROWSER_KILL_CMD = {
 }[os.name]
 BROWSER_ID = 'chrome'
 BROWSER_PROFILE_DIR = 'selenium'
+DAEMON_PORT = 9222
+# Linux ioctl cloning a file as a copy-on-write reflink
+FICLONE = 0x40049409
+LEAN_ARGS = [
+    '--blink-settings=imagesEnabled=false',
+    '--disable-extensions',
+    '--disable-gpu',
+    '--disable-background-networking',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--mute-audio',
+    '--window-size=1024,768',
+]
+BLOCKED_URL_PATTERNS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.mp4', '*.webm', '*.mp3',
+    '*doubleclick.net*', '*googlesyndication.com*',
+    '*google-analytics.com*', '*googletagmanager.com*',
+]
+PROFILE_CACHE_DIRS = ['Cache', 'Code Cache', 'DawnCache', 'DawnGraphiteCache',
+    'DawnWebGPUCache', 'GPUCache', 'GrShaderCache', 'ShaderCache',
+    'Service Worker', 'blob_storage']
 
 
 class Browser:
     def __init__(self, browser_id=BROWSER_ID, profile_dir=BROWSER_PROFILE_DIR,
-            headless=False, page_load_strategy=None):
+            headless=False, page_load_strategy=None, data_dir=None,
+            kill_running=True, lean=False):
         self.profile_dir = profile_dir
         self.headless = headless
+        self.lean = lean
         self.page_load_strategy = page_load_strategy
+        self.kill_running = kill_running
         config = self._get_config(browser_id)
-        self.data_dir = config['data_dir']
+        self.data_dir = data_dir or config['data_dir']
         self.binary = config['binary']
 
     def _get_config(self, browser_id):
@@ -64,17 +104,34 @@ class Browser:
         subprocess.call(BROWSER_KILL_CMD.format(
             binary=os.path.basename(self.binary)), shell=True)
 
+    def get_args(self):
+        args = [
+            f'--user-data-dir={self.data_dir}',
+            f'--profile-directory={self.profile_dir}',
+            '--disable-blink-features=AutomationControlled',
+        ]
+        args += LEAN_ARGS if self.lean else ['--start-maximized']
+        if self.headless:
+            args.append('--headless')
+        return args
+
+    def attach_driver(self, debugger_address):
+        options = Options()
+        if self.page_load_strategy:
+            options.page_load_strategy = self.page_load_strategy
+        options.debugger_address = debugger_address
+        driver = webdriver.Chrome(options=options)
+        driver.implicitly_wait(1)
+        return driver
+
     def get_driver(self):
-        self._kill_running_browser()
+        if self.kill_running:
+            self._kill_running_browser()
         options = Options()
-        if self.headless:
-            options.add_argument('--headless')
         if self.page_load_strategy:
             options.page_load_strategy = self.page_load_strategy
-        options.add_argument(f'--user-data-dir={self.data_dir}')
-        options.add_argument(f'--profile-directory={self.profile_dir}')
-        options.add_argument('--start-maximized')
-        options.add_argument('--disable-blink-features=AutomationControlled')
+        for arg in self.get_args():
+            options.add_argument(arg)
         options.add_experimental_option('useAutomationExtension', False)
         options.add_experimental_option('excludeSwitches',
             ['enable-automation'])
@@ -85,5 +142,235 @@ class Browser:
         return driver
 
 
+class BrowserDaemon:
+    """Long-lived browser that drivers attach to through its remote
+    debugging port, recycled after max_pages page loads or when its
+    memory usage exceeds max_rss bytes.
+    """
+
+    def __init__(self, state_file, port=DAEMON_PORT, max_pages=None,
+            max_rss=None, start_timeout=20, **browser_kwargs):
+        self.state_file = state_file
+        self.port = port
+        self.max_pages = max_pages
+        self.max_rss = max_rss
+        self.start_timeout = start_timeout
+        self.browser = Browser(kill_running=False, **browser_kwargs)
+        self.state = self._load_state()
+
+    @property
+    def debugger_address(self):
+        return f'127.0.0.1:{self.port}'
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self):
+        with open(self.state_file, 'w') as fd:
+            json.dump(self.state, fd)
+
+    def is_healthy(self, timeout=2):
+        try:
+            with urllib.request.urlopen(f'http://{self.debugger_address}'
+                    '/json/version', timeout=timeout) as res:
+                return res.status == 200
+        except Exception:
+            return False
+
+    def _get_process(self):
+        try:
+            return psutil.Process(self.state['pid'])
+        except (psutil.Error, KeyError, TypeError):
+            return None
+
+    def get_rss(self):
+        process = self._get_process()
+        if not process:
+            return 0
+        rss = 0
+        for proc in [process] + process.children(recursive=True):
+            try:
+                rss += proc.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _needs_recycling(self):
+        if self.state.get('args') != self.browser.get_args():
+            return True
+        if self.max_pages and self.state['pages'] >= self.max_pages:
+            return True
+        return bool(self.max_rss and self.get_rss() > self.max_rss)
+
+    def start(self):
+        kwargs = {'creationflags': subprocess.DETACHED_PROCESS} \
+            if os.name == 'nt' else {'start_new_session': True}
+        process = subprocess.Popen([self.browser.binary,
+                f'--remote-debugging-port={self.port}',
+                '--no-first-run', '--no-default-browser-check']
+                + self.browser.get_args() + ['about:blank'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+        self.state = {
+            'pid': process.pid,
+            'args': self.browser.get_args(),
+            'pages': 0,
+            'started_ts': time.time(),
+        }
+        self._save_state()
+        end_ts = time.time() + self.start_timeout
+        while time.time() < end_ts:
+            if self.is_healthy():
+                return
+            time.sleep(.2)
+        self.stop()
+        raise Exception('failed to start the browser daemon')
+
+    def stop(self):
+        process = self._get_process()
+        if process:
+            for proc in process.children(recursive=True) + [process]:
+                try:
+                    proc.kill()
+                except psutil.Error:
+                    pass
+        self.state = None
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def get_driver(self):
+        if self.state and self.is_healthy():
+            if not self._needs_recycling():
+                return self.browser.attach_driver(self.debugger_address)
+            self.stop()
+        elif self.state:
+            self.stop()
+        self.start()
+        return self.browser.attach_driver(self.debugger_address)
+
+    def add_pages(self, count):
+        if self.state:
+            self.state['pages'] += count
+            self._save_state()
+
+
+def _clone_file(src, dst):
+    if fcntl:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def clone_profile(src_data_dir, profile_dir, dst_data_dir):
+    """Copies a browser profile without its caches, using reflinks when
+    the filesystem supports them.
+    """
+    os.makedirs(dst_data_dir, exist_ok=True)
+    local_state = os.path.join(src_data_dir, 'Local State')
+    if os.path.exists(local_state):
+        _clone_file(local_state, os.path.join(dst_data_dir, 'Local State'))
+    src_profile = os.path.join(src_data_dir, profile_dir)
+    if not os.path.exists(src_profile):
+        return
+    try:
+        shutil.copytree(src_profile, os.path.join(dst_data_dir, profile_dir),
+            ignore=shutil.ignore_patterns(*PROFILE_CACHE_DIRS),
+            copy_function=_clone_file, dirs_exist_ok=True)
+    except shutil.Error:
+        # Files locked by a running browser, the rest is copied
+        pass
+
+
+class ProfilePool:
+    """Gives each driver its own data dir, cloned from a template
+    profile holding cookies and logins, so several browsers can run
+    side by side.
+
+    The template is seeded from the browser data dir on first use.
+    Profiles of dead processes are removed on acquire. Template changes
+    and copies are serialized across processes by a lock file.
+    """
+
+    def __init__(self, base_path, browser_id=BROWSER_ID,
+            profile_dir=BROWSER_PROFILE_DIR):
+        self.base_path = base_path
+        self.profile_dir = profile_dir
+        self.source_data_dir = Browser(browser_id=browser_id).data_dir
+        self.template_dir = os.path.join(base_path, 'template')
+
+    def cleanup(self):
+        for path in glob(os.path.join(self.base_path, 'profile-*')):
+            try:
+                pid = int(os.path.basename(path).split('-')[1])
+            except (IndexError, ValueError):
+                continue
+            if not psutil.pid_exists(pid):
+                shutil.rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self.base_path, exist_ok=True)
+        with open(os.path.join(self.base_path, 'template.lock'), 'w') as fd:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+
+    def _replace_template(self, src_data_dir):
+        tmp_dir = f'{self.template_dir}-{uuid4().hex[:8]}'
+        clone_profile(src_data_dir, self.profile_dir, tmp_dir)
+        shutil.rmtree(self.template_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.template_dir)
+
+    def _seed_template(self):
+        if not os.path.exists(self.template_dir):
+            self._replace_template(self.source_data_dir)
+
+    def acquire(self):
+        self.cleanup()
+        path = os.path.join(self.base_path,
+            f'profile-{os.getpid()}-{uuid4().hex[:8]}')
+        with self._lock():
+            self._seed_template()
+            clone_profile(self.template_dir, self.profile_dir, path)
+        return path
+
+    def get_shared(self, name):
+        """Returns a data dir kept across runs, e.g. for a long-lived
+        browser, cloned from the template on first use.
+        """
+        path = os.path.join(self.base_path, name)
+        with self._lock():
+            if not os.path.exists(path):
+                self._seed_template()
+                tmp_dir = f'{path}-{uuid4().hex[:8]}'
+                clone_profile(self.template_dir, self.profile_dir, tmp_dir)
+                os.replace(tmp_dir, path)
+        return path
+
+    def release(self, path, update_template=False):
+        """Removes the profile, making it the new template first if
+        update_template, e.g. after a user login.
+        """
+        if update_template:
+            with self._lock():
+                self._replace_template(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def block_urls(driver, patterns=None):
+    """Blocks requests matching the url patterns in the current tab."""
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs',
+        {'urls': BLOCKED_URL_PATTERNS if patterns is None else patterns})
+
+
 def get_browser_driver(*args, **kwargs):
     return Browser(*args, **kwargs).get_driver()
@@ -10,7 +10,9 @@ setup(
     python_requires='>=3.10',
     install_requires=[
         'svcutils @ git+https://github.com/jererc/svcutils.git@main#egg=svcutils',
-        'webutils @ git+https://github.com/jererc/webutils.git@main#egg=webutils',
+        'psutil',
+        'selenium',
+        'urllib3',
     ],
     extras_require={
         'dev': ['flake8', 'pytest'],
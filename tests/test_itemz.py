@@ -1,15 +1,60 @@
+import fcntl
+from functools import partial
+import hashlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
 import os
 from pprint import pprint
+import queue
+import shutil
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest.mock import ANY, Mock, patch
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
 REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, os.path.join(REPO_PATH, 'itemz'))
+FIXTURES_PATH = os.path.join(REPO_PATH, 'tests', 'fixtures')
 import itemz
 import user_settings
+import webutils
 assert itemz.WORK_PATH == user_settings.WORK_PATH
 
 
+class ImportTestCase(unittest.TestCase):
+    def test_lazy_browser_import(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        output = subprocess.check_output([sys.executable, '-c',
+            'import sys, itemz; print(sorted(itemz.PARSERS)); '
+            'print("selenium" in sys.modules, "webutils" in sys.modules)'],
+            env=env, text=True)
+        self.assertEqual(output.splitlines(), [
+            "['1337x', '1337x_http', 'rutracker']",
+            'False False',
+        ])
+
+    def test_package_webutils(self):
+        env = dict(os.environ)
+        # As installed, without the module dir in the path
+        env['PYTHONPATH'] = os.pathsep.join([REPO_PATH] + [r for r in sys.path
+            if r != os.path.join(REPO_PATH, 'itemz')])
+        output = subprocess.check_output([sys.executable, '-c',
+            'from itemz import itemz; '
+            'print(itemz.import_webutils().__name__)'],
+            env=env, text=True, cwd=tempfile.gettempdir())
+        self.assertEqual(output.strip(), 'itemz.webutils')
+
+    def test_register_parser(self):
+        self.assertRaises(Exception, itemz.register_parser,
+            itemz.X1337xParser)
+        self.assertIs(itemz.PARSERS['1337x'], itemz.X1337xParser)
+
+
 class CleanItemTestCase(unittest.TestCase):
     def test_1(self):
         item = 'L.A. Noire: The Complete Edition (v2675.1 + All DLCs, MULTi6) [FitGirl Repack]'
@@ -35,6 +80,31 @@ class CleanItemTestCase(unittest.TestCase):
         item = '[X] L.A. Noire (v2675.1 + All DLCs, MULTi6) [FitGirl Repack]'
         self.assertEqual(itemz.clean_item(item), 'L.A. Noire')
 
+    def test_canonical(self):
+        items = [
+            ('Monster Hunter Wilds (v1.0 + DLC, MULTi13) [FitGirl Repack]',
+                'monster hunter wilds'),
+            ('Elden Ring v1.12.3 - FitGirl Repack', 'elden ring'),
+            ('ELDEN RING-DODI', 'elden ring'),
+            ('Cyberpunk 2077 Repack', 'cyberpunk 2077'),
+            ('Battlefield 1 (2016)', 'battlefield 1'),
+            ('v1.0', 'v1.0'),
+        ]
+        self.assertEqual(itemz.clean_items([r for r, _ in items],
+            canonical=True), [r for _, r in items])
+
+    def test_batch(self):
+        items = [
+            'L.A. Noire [X] (v2675.1 + All DLCs, MULTi6) [FitGirl Repack]',
+            'L.A. Noire: The Complete Edition (v2675.1 + All DLCs, ...',
+            'No tags',
+        ]
+        self.assertEqual(itemz.clean_items(items), [
+            'L.A. Noire',
+            'L.A. Noire: The Complete Edition',
+            'No tags',
+        ])
+
 
 class URLIdTestCase(unittest.TestCase):
     def test_1(self):
@@ -71,3 +141,1192 @@ class URLIdTestCase(unittest.TestCase):
         url = 'https://1337x.to/sort-search/monster%20hunter%20repack/time/desc/1/'
         url_gen = itemz.URLIdGenerator([url])
         self.assertEqual(url_gen.shorten(url), '1337x.to')
+
+    def test_add_remove(self):
+        urls = [
+            'https://1337x.to/user/FitGirl/',
+            'https://1337x.to/user/DODI/',
+        ]
+        url_gen = itemz.URLIdGenerator(urls[:1])
+        self.assertEqual(url_gen.shorten(urls[0]), '1337x.to')
+        self.assertEqual(url_gen.shorten(urls[1]), '1337x.to DODI')
+        url_gen.add(urls[1])
+        self.assertEqual(url_gen.get_ids(), {
+            urls[0]: '1337x.to FitGirl',
+            urls[1]: '1337x.to DODI',
+        })
+        url_gen.remove(urls[0])
+        self.assertEqual(url_gen.get_ids(), {urls[1]: '1337x.to'})
+        self.assertEqual(url_gen.token_counts, {'user': 1, 'DODI': 1})
+
+    def test_cache(self):
+        file = os.path.join(tempfile.mkdtemp(), 'url-ids.json')
+        urls = [
+            'https://1337x.to/user/FitGirl/',
+            'https://1337x.to/user/DODI/',
+        ]
+        url_gen = itemz.URLIdGenerator.load(file, urls)
+        self.assertEqual(url_gen.shorten(urls[0]), '1337x.to FitGirl')
+        with patch.object(itemz.URLIdGenerator, '_get_id') as get_id:
+            url_gen = itemz.URLIdGenerator.load(file, list(reversed(urls)))
+            self.assertEqual(url_gen.shorten(urls[1]), '1337x.to DODI')
+        get_id.assert_not_called()
+        url_gen = itemz.URLIdGenerator.load(file, urls[:1])
+        self.assertEqual(url_gen.shorten(urls[0]), '1337x.to')
+        self.assertEqual(len(itemz.load_json(file)), 2)
+        shutil.rmtree(os.path.dirname(file))
+
+
+def get_page_state(texts=None, marker=None, loading=False):
+    return {'texts': texts, 'marker': marker, 'loading': loading}
+
+
+class BatchExtractTestCase(unittest.TestCase):
+    def _get_parser(self, parser_cls, *states):
+        driver = Mock()
+        driver.execute_async_script.side_effect = list(states)
+        with patch.object(webutils, 'get_browser_driver', return_value=driver):
+            return parser_cls()
+
+    def test_1337x(self):
+        parser = self._get_parser(itemz.X1337xParser,
+            get_page_state(['name 1\n5', ' name 2 \n3', None]))
+        res = parser.parse('https://1337x.to/user/FitGirl/')
+        self.assertEqual(sorted(res.keys()), ['name 1', 'name 2'])
+        self.assertTrue(res['name 1'] > res['name 2'])
+        self.assertEqual(parser.driver.execute_async_script.call_count, 1)
+        self.assertFalse(parser.driver.find_elements.called)
+
+    def test_rutracker(self):
+        parser = self._get_parser(itemz.RutrackerParser,
+            get_page_state([' name 1 ']))
+        res = parser.parse('https://rutracker.org/forum/tracker.php?f=557')
+        self.assertEqual(list(res.keys()), ['name 1'])
+
+
+class WaitTestCase(BatchExtractTestCase):
+    def test_no_results(self):
+        parser = self._get_parser(itemz.X1337xParser,
+            get_page_state(marker='no_results'))
+        self.assertEqual(parser.parse('https://1337x.to/search/x/1/'), {})
+
+    def test_requires_login(self):
+        parser = self._get_parser(itemz.RutrackerParser,
+            get_page_state(marker='login'))
+        self.assertRaisesRegex(Exception, 'requires login', parser.parse,
+            'https://rutracker.org/forum/tracker.php?f=557')
+
+    def test_loading(self):
+        parser = self._get_parser(itemz.X1337xParser,
+            get_page_state(['name 1'], loading=True),
+            get_page_state(['name 1', 'name 2']))
+        res = parser.parse('https://1337x.to/user/FitGirl/')
+        self.assertEqual(sorted(res.keys()), ['name 1', 'name 2'])
+
+    def test_timeout(self):
+        parser = self._get_parser(itemz.X1337xParser,
+            *[get_page_state()] * 2)
+        with patch.object(itemz, 'MAX_WAIT_TIMEOUT', 0):
+            self.assertRaisesRegex(Exception, 'timeout', parser.parse,
+                'https://1337x.to/user/FitGirl/')
+
+    def test_adaptive_timeout(self):
+        parser = self._get_parser(itemz.X1337xParser)
+        url = 'https://1337x.to/user/FitGirl/'
+        self.assertEqual(parser.load_times.get_timeout(url),
+            itemz.MAX_WAIT_TIMEOUT)
+        parser.load_times.add(url, .1)
+        self.assertEqual(parser.load_times.get_timeout(url),
+            itemz.MIN_WAIT_TIMEOUT)
+        parser.load_times.add(url, 2)
+        self.assertEqual(parser.load_times.get_timeout(url), 6)
+
+
+class TabsTestCase(unittest.TestCase):
+    def _get_driver(self):
+        driver = Mock(window_handles=['h0'])
+        current = {'handle': 'h0'}
+        urls = {}
+
+        def new_window(type_hint):
+            current['handle'] = f'h{len(driver.window_handles)}'
+            driver.window_handles.append(current['handle'])
+
+        def get(url):
+            if 'error' in url:
+                raise Exception('get error')
+            urls[current['handle']] = url
+
+        driver.switch_to.new_window.side_effect = new_window
+        driver.switch_to.window.side_effect = \
+            lambda h: current.update(handle=h)
+        driver.get.side_effect = get
+        driver.execute_async_script.side_effect = \
+            lambda *a: get_page_state([f'name {urls[current["handle"]]}'])
+        return driver
+
+    def test_1(self):
+        urls = [f'https://1337x.to/user/{i}/' for i in range(5)]
+        with patch.object(webutils, 'get_browser_driver',
+                return_value=self._get_driver()):
+            parser = itemz.X1337xParser(tabs=3)
+        res = list(parser.iterate_items(urls))
+        self.assertEqual(len(parser.driver.window_handles), 3)
+        self.assertEqual(sorted(r[0] for r in res), sorted(urls))
+        for url, items, exc in res:
+            self.assertIsNone(exc)
+            self.assertEqual(list(items.keys()), [f'name {url}'])
+
+    def test_load_error(self):
+        urls = [f'https://1337x.to/user/{i}/' for i in range(3)]
+        error_url = 'https://1337x.to/user/error/'
+        with patch.object(webutils, 'get_browser_driver',
+                return_value=self._get_driver()):
+            parser = itemz.X1337xParser(tabs=3)
+        parser.breaker.record = Mock(wraps=parser.breaker.record)
+        res = list(parser.iterate_items(urls[:1] + [error_url] + urls[1:]))
+        self.assertEqual(sorted(r[0] for r in res if not r[2]), urls)
+        errors = [r for r in res if r[2]]
+        self.assertEqual([r[0] for r in errors], [error_url])
+        self.assertEqual(str(errors[0][2]), 'get error')
+        parser.breaker.record.assert_any_call(error_url, success=False)
+
+    def test_probe(self):
+        urls = [f'https://1337x.to/user/{i}/' for i in range(4)]
+        with patch.object(webutils, 'get_browser_driver',
+                return_value=self._get_driver()):
+            parser = itemz.X1337xParser(tabs=3)
+        parser.breaker.data['1337x.to'] = {'failures': 3, 'backoff': 3600,
+            'next_probe_ts': 0}
+        res = list(parser.iterate_items(urls))
+        self.assertEqual([r[0] for r in res][0], urls[0])
+        self.assertEqual(sorted(r[0] for r in res), urls)
+        self.assertFalse([r for r in res if r[2]])
+        self.assertNotIn('1337x.to', parser.breaker.data)
+
+    def test_lean(self):
+        urls = [f'https://1337x.to/user/{i}/' for i in range(5)]
+        with patch.object(webutils, 'get_browser_driver',
+                return_value=self._get_driver()) as get_browser_driver, \
+                patch.object(itemz, 'LEAN_BROWSER_PARSERS', {'1337x'}):
+            parser = itemz.X1337xParser(tabs=3)
+            list(parser.iterate_items(urls))
+        self.assertTrue(get_browser_driver.call_args.kwargs['lean'])
+        blocked_tabs = [c for c in parser.driver.execute_cdp_cmd.call_args_list
+            if c.args[0] == 'Network.setBlockedURLs']
+        self.assertEqual(len(blocked_tabs), 3)
+
+
+class FakeParser(itemz.Parser):
+    id = 'fake'
+
+    def parse(self, url):
+        if 'error' in url:
+            raise Exception('parse error')
+        return {f'item {url}': 1}
+
+
+class KnownItemsParser(FakeParser):
+    def parse(self, url):
+        return self._get_items(url, [f'item {url}', 'old 1', 'old 2'])
+
+
+class HangingParser(FakeParser):
+    def parse(self, url):
+        if 'hang' in url:
+            time.sleep(60)
+        return super().parse(url)
+
+
+class StageTestCase(unittest.TestCase):
+    def test_1(self):
+        res = []
+        event = threading.Event()
+
+        def handler(value):
+            event.wait()
+            if value == 2:
+                raise Exception('handler error')
+            res.append(value)
+
+        stage = itemz.Stage('test', handler, maxsize=1)
+        stage.put(1)
+        stage.put(2)
+        self.assertRaises(queue.Full, stage.queue.put, (3,), timeout=.1)
+        event.set()
+        stage.put(3)
+        stage.close()
+        self.assertEqual(res, [1, 3])
+        self.assertFalse(stage.thread.is_alive())
+
+
+class BrowserDaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.work_path, 'daemon.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def _get_driver(self, healthy=True, rss=0, **kwargs):
+        daemon = webutils.BrowserDaemon(self.state_file, max_pages=10,
+            max_rss=1000, **kwargs)
+        with patch.object(daemon, 'is_healthy', return_value=healthy), \
+                patch.object(daemon, 'get_rss', return_value=rss), \
+                patch.object(daemon, 'stop') as stop, \
+                patch.object(daemon.browser, 'attach_driver'), \
+                patch.object(webutils.subprocess, 'Popen') as popen:
+            popen.return_value.pid = 123
+            daemon.get_driver()
+        return daemon, popen.called, stop.called
+
+    def test_recycle(self):
+        daemon, started, stopped = self._get_driver()
+        self.assertTrue(started)
+        self.assertEqual(daemon.state['pid'], 123)
+        daemon.add_pages(5)
+        daemon, started, stopped = self._get_driver()
+        self.assertFalse(started)
+        daemon, started, stopped = self._get_driver(rss=2000)
+        self.assertTrue(started and stopped)
+        daemon.add_pages(10)
+        daemon, started, stopped = self._get_driver()
+        self.assertTrue(started and stopped)
+        daemon, started, stopped = self._get_driver(headless=True)
+        self.assertTrue(started and stopped)
+
+    def test_parser(self):
+        driver = Mock()
+        with patch.object(itemz, 'WORK_PATH', self.work_path), \
+                patch.object(itemz, 'BROWSER_DAEMON', True), \
+                patch.object(webutils.ProfilePool, '_seed_template'), \
+                patch.object(webutils.BrowserDaemon, 'get_driver',
+                    return_value=driver), \
+                patch.object(webutils, 'get_browser_driver') as get_driver:
+            parser = itemz.X1337xParser()
+        self.assertIs(parser.driver, driver)
+        get_driver.assert_not_called()
+        data_dir = os.path.join(self.work_path, 'browsers', 'daemon')
+        self.assertTrue(os.path.exists(data_dir))
+        self.assertIn(f'--user-data-dir={data_dir}',
+            parser.daemon.browser.get_args())
+
+    def test_lean_parser(self):
+        daemons = []
+        with patch.object(itemz, 'WORK_PATH', self.work_path), \
+                patch.object(itemz, 'BROWSER_DAEMON', True), \
+                patch.object(itemz, 'LEAN_BROWSER_PARSERS', {'1337x'}), \
+                patch.object(webutils.ProfilePool, '_seed_template'), \
+                patch.object(webutils.BrowserDaemon, 'get_driver'):
+            for parser_cls in [itemz.X1337xParser, itemz.RutrackerParser]:
+                daemons.append(parser_cls().daemon)
+        self.assertEqual([r.port for r in daemons], [9223, 9222])
+        self.assertEqual([os.path.basename(r.state_file) for r in daemons],
+            ['browser-daemon-lean.json', 'browser-daemon.json'])
+        self.assertEqual([os.path.basename(r.browser.data_dir)
+            for r in daemons], ['daemon-lean', 'daemon'])
+
+    def test_unhealthy(self):
+        self._get_driver()
+        self.assertRaisesRegex(Exception, 'failed to start',
+            self._get_driver, healthy=False, start_timeout=0)
+
+
+class ProfilePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.work_path, 'source')
+        for file in ['Local State', 'selenium/Cookies', 'selenium/Cache/x']:
+            self._write(os.path.join(self.source_dir, file), 'source')
+        self.pool = webutils.ProfilePool(os.path.join(self.work_path,
+            'browsers'))
+        self.pool.source_data_dir = self.source_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def _write(self, file, data):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, 'w') as fd:
+            fd.write(data)
+
+    def _read(self, file):
+        with open(file) as fd:
+            return fd.read()
+
+    def test_acquire(self):
+        path = self.pool.acquire()
+        self.assertEqual(self._read(os.path.join(path, 'Local State')),
+            'source')
+        cookies = os.path.join(path, 'selenium', 'Cookies')
+        self.assertEqual(self._read(cookies), 'source')
+        self.assertFalse(os.path.exists(os.path.join(path, 'selenium',
+            'Cache')))
+        self._write(cookies, 'login')
+        self.assertNotEqual(self.pool.acquire(), path)
+        self.assertEqual(self._read(os.path.join(self.pool.template_dir,
+            'selenium', 'Cookies')), 'source')
+        self.pool.release(path, update_template=True)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self._read(os.path.join(self.pool.acquire(),
+            'selenium', 'Cookies')), 'login')
+
+    def test_concurrent_acquire(self):
+        clone_profile = webutils.clone_profile
+        active = []
+        res = {'max_active': 0, 'seeded': 0}
+
+        def slow_clone_profile(src_data_dir, *args):
+            active.append(src_data_dir)
+            res['max_active'] = max(res['max_active'], len(active))
+            if src_data_dir == self.source_dir:
+                res['seeded'] += 1
+            time.sleep(.05)
+            clone_profile(src_data_dir, *args)
+            active.remove(src_data_dir)
+
+        paths = []
+        with patch.object(webutils, 'clone_profile', slow_clone_profile):
+            threads = [threading.Thread(target=lambda: paths.append(
+                self.pool.acquire())) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(res, {'max_active': 1, 'seeded': 1})
+        self.assertEqual(len(set(paths)), 4)
+        for path in paths:
+            self.assertEqual(self._read(os.path.join(path, 'selenium',
+                'Cookies')), 'source')
+
+    def test_cleanup(self):
+        path = self.pool.acquire()
+        dead_path = os.path.join(self.pool.base_path, 'profile-999999999-x')
+        os.makedirs(dead_path)
+        self.pool.cleanup()
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(dead_path))
+
+
+class CollectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.storage_path = os.path.join(self.work_path, 'items')
+        for key, value in [('WORK_PATH', self.work_path),
+                ('NOTIF_MIN_INTERVAL', 0)]:
+            patcher = patch.object(itemz, key, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        itemz.metrics.reset()
+
+    def tearDown(self):
+        itemz.SqliteItemStorage.close()
+        shutil.rmtree(self.work_path)
+
+    def _run(self, urls):
+        collector = itemz.ItemCollector(Mock(URLS={'fake': urls},
+            ITEM_STORAGE_PATH=self.storage_path))
+        collector.parsers['fake'] = FakeParser
+        with patch.object(itemz, 'Notifier') as notifier:
+            collector.run()
+        return collector, notifier.return_value.send.call_count
+
+
+class FingerprintTestCase(CollectorTestCase):
+    def test_1(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        collector, notif_count = self._run(urls)
+        self.assertEqual(collector.unchanged_count, 0)
+        self.assertEqual(notif_count, 2)
+        with patch.object(itemz.SqliteItemStorage, 'get_new_items') as gni:
+            collector, notif_count = self._run(urls)
+        self.assertFalse(gni.called)
+        self.assertEqual(collector.unchanged_count, 2)
+        self.assertEqual(notif_count, 0)
+
+
+class PagedParser(itemz.Parser):
+    id = 'paged'
+    pages = []
+
+    def _get_next_page_names(self):
+        return self.pages.pop(0) if self.pages else None
+
+    def parse(self, url):
+        return self._get_items(url, self._get_next_page_names())
+
+
+class IncrementalTestCase(unittest.TestCase):
+    def _parse(self, pages, known):
+        parser = PagedParser()
+        parser.pages = pages
+        parser.known_items = lambda url, names: set(names) & known
+        with patch.object(itemz, 'KNOWN_ITEMS_STOP', 2), \
+                patch.object(itemz, 'MAX_NEXT_PAGES', 2):
+            items = parser.parse('https://a.com')
+        return [k for k, _ in sorted(items.items(), key=lambda x: -x[1])]
+
+    def test_stop_on_known(self):
+        res = self._parse([['n1', 'k1', 'n2', 'k2', 'k3', 'k4']],
+            known={'k1', 'k2', 'k3', 'k4'})
+        self.assertEqual(res, ['n1', 'k1', 'n2', 'k2', 'k3'])
+
+    def test_next_pages(self):
+        res = self._parse([['n1', 'n2'], ['n3', 'k1', 'k2', 'k3'], ['n4']],
+            known={'k1', 'k2', 'k3'})
+        self.assertEqual(res, ['n1', 'n2', 'n3', 'k1', 'k2'])
+
+    def test_no_new_page(self):
+        res = self._parse([['n1'], ['k1'], ['n2']], known={'k1'})
+        self.assertEqual(res, ['n1', 'k1'])
+
+    def test_max_pages(self):
+        res = self._parse([['n1'], ['n2'], ['n3'], ['n4']], known=set())
+        self.assertEqual(res, ['n1', 'n2', 'n3'])
+
+
+class SharedItemParser(itemz.Parser):
+    id = 'shared'
+
+    def parse(self, url):
+        return {'shared item [1080p]': 1, f'item {url}': 2}
+
+
+class ItemIndexTestCase(CollectorTestCase):
+    def test_1(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        collector = itemz.ItemCollector(Mock(URLS={'shared': urls},
+            ITEM_STORAGE_PATH=self.storage_path))
+        collector.parsers['shared'] = SharedItemParser
+        with patch.object(itemz, 'Notifier') as notifier:
+            collector.run()
+        bodies = sorted(c.kwargs['body']
+            for c in notifier.return_value.send.call_args_list)
+        self.assertEqual(bodies, [
+            'item https://a.com/2',
+            'shared item\nitem https://a.com/1',
+        ])
+        self.assertEqual(collector.item_index.get('shared item (x265)'),
+            {'url': 'https://a.com/1', 'first_seen': ANY})
+
+        index = itemz.ItemIndex(self.storage_path)
+        self.assertEqual(set(index.data.keys()),
+            {'shared item', 'item https://a.com/1', 'item https://a.com/2'})
+        index.save({'https://a.com/2'})
+        self.assertEqual(set(index.data.keys()), {'item https://a.com/2'})
+
+
+class JsonStoreTestCase(CollectorTestCase):
+    def test_merge(self):
+        file = os.path.join(self.work_path, 'store.json')
+        store1 = itemz.JsonStore(file)
+        store2 = itemz.JsonStore(file)
+        store1.data.update({'a': 1, 'b': 1})
+        store1.updated.update({'a', 'b'})
+        store1.save()
+        store2.data['c'] = 2
+        store2.updated.add('c')
+        store2.save()
+        self.assertEqual(store2.data, {'a': 1, 'b': 1, 'c': 2})
+        del store1.data['a']
+        store1.updated.add('a')
+        store1.save(keep=lambda k, v: k != 'b')
+        self.assertEqual(itemz.load_json(file), {'c': 2})
+
+    def test_lock(self):
+        file = os.path.join(self.work_path, 'store.json')
+        store = itemz.JsonStore(file)
+        store.data['a'] = 1
+        store.updated.add('a')
+        save_json = itemz.save_json
+
+        def locked_save_json(*args):
+            with open(f'{file}.lock') as fd:
+                self.assertRaises(BlockingIOError, fcntl.flock, fd,
+                    fcntl.LOCK_EX | fcntl.LOCK_NB)
+            save_json(*args)
+
+        with patch.object(itemz, 'save_json', locked_save_json):
+            store.save()
+        self.assertEqual(itemz.load_json(file), {'a': 1})
+
+    def test_schedule(self):
+        file = os.path.join(self.work_path, 'schedule.json')
+        urls = ['https://a.com/1', 'https://a.com/2']
+        schedule1 = itemz.UrlSchedule(file)
+        schedule2 = itemz.UrlSchedule(file)
+        schedule1.record_run(urls[0], 1)
+        schedule2.record_run(urls[1], 0)
+        schedule1.save(set(urls))
+        schedule2.save(set(urls))
+        self.assertEqual(set(itemz.load_json(file).keys()), set(urls))
+
+
+class MetricsTestCase(CollectorTestCase):
+    def _load_spans(self):
+        with open(os.path.join(self.work_path, 'metrics.jsonl')) as fd:
+            return [json.loads(r) for r in fd]
+
+    def test_collector(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        self._run(urls)
+        spans = self._load_spans()
+        self.assertEqual({r['name'] for r in spans}, {'parse', 'parser',
+            'storage_load', 'diff', 'save', 'notify'})
+        parse_spans = [r for r in spans if r['name'] == 'parse']
+        self.assertEqual([(r['url'], r['rows']) for r in parse_spans],
+            [(urls[0], 1), (urls[1], 1)])
+
+        with open(os.path.join(self.work_path,
+                f'{itemz.NAME}.prom')) as fd:
+            lines = fd.read().splitlines()
+        self.assertIn(f'{itemz.NAME}_phase_count'
+            '{phase="parse",parser="fake"} 2', lines)
+        self.assertIn(f'{itemz.NAME}_phase_rows'
+            '{phase="diff",parser="fake"} 2', lines)
+        self.assertIn(f'{itemz.NAME}_urls 2', lines)
+
+        self._run(urls)
+        # Unchanged urls are not processed
+        self.assertEqual(len(self._load_spans()), len(spans) + 3)
+
+    def test_workers(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        with patch.object(itemz, 'PARSER_WORKERS', 2), \
+                patch.object(itemz, 'URLS_PER_WORKER', 1):
+            self._run(urls)
+        spans = self._load_spans()
+        self.assertEqual(sorted(r['url'] for r in spans
+            if r['name'] == 'parse'), urls)
+        self.assertEqual(len([r for r in spans if r['name'] == 'parser']), 2)
+
+    def test_profile(self):
+        config = Mock(URLS={}, ITEM_STORAGE_PATH=self.storage_path)
+        with patch('sys.stdout'):
+            itemz.collect_items(config, profile=True)
+        self.assertTrue(os.path.exists(os.path.join(self.work_path,
+            f'{itemz.NAME}.prof')))
+
+
+class UrlScheduleTestCase(CollectorTestCase):
+    def test_interval(self):
+        url = 'https://a.com/1'
+        schedule = itemz.UrlSchedule(os.path.join(self.work_path, 's'))
+        self.assertTrue(schedule.is_due(url))
+        schedule.record_run(url, 0)
+        self.assertFalse(schedule.is_due(url))
+        self.assertEqual(schedule.data[url]['interval'],
+            itemz.SCHEDULE_MIN_INTERVAL * itemz.SCHEDULE_BACKOFF_FACTOR)
+        for i in range(20):
+            schedule.record_run(url, 0)
+        self.assertEqual(schedule.data[url]['interval'],
+            itemz.SCHEDULE_MAX_INTERVAL)
+        self.assertEqual(len(schedule.data[url]['new_items']),
+            itemz.SCHEDULE_HISTORY_SIZE)
+        schedule.record_run(url, 3)
+        self.assertEqual(schedule.data[url]['interval'],
+            itemz.SCHEDULE_MAX_INTERVAL // 2)
+        self.assertEqual(schedule.data[url]['new_items'][-1], 3)
+        with patch.object(time, 'time',
+                return_value=time.time() + itemz.SCHEDULE_MAX_INTERVAL // 2):
+            self.assertTrue(schedule.is_due(url))
+
+    def test_collector(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        with patch.object(itemz, 'ADAPTIVE_SCHEDULE', True):
+            collector, notif_count = self._run(urls)
+            self.assertEqual(notif_count, 2)
+            self.assertEqual(collector.urls, {'fake': urls})
+            self.assertIsNotNone(
+                collector.schedule.data[urls[0]]['duration'])
+
+            collector, notif_count = self._run(urls + ['https://a.com/3'])
+            self.assertEqual(collector.urls, {'fake': ['https://a.com/3']})
+            self.assertEqual(notif_count, 1)
+            self.assertEqual(set(collector.schedule.data.keys()),
+                set(urls + ['https://a.com/3']))
+
+    def test_duration(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        put = itemz.Stage.put
+
+        def slow_put(stage, *args):
+            time.sleep(.2)
+            put(stage, *args)
+
+        with patch.object(itemz, 'ADAPTIVE_SCHEDULE', True), \
+                patch.object(itemz.Stage, 'put', slow_put):
+            collector, notif_count = self._run(urls)
+        self.assertEqual(notif_count, 2)
+        for url in urls:
+            self.assertLess(collector.schedule.data[url]['duration'], .1)
+
+
+class ShardStoreTestCase(CollectorTestCase):
+    def test_leases(self):
+        file = os.path.join(self.work_path, 'shards.db')
+        urls = [f'https://a.com/{i}' for i in range(5)]
+        store1 = itemz.ShardStore(file, 'worker1')
+        store2 = itemz.ShardStore(file, 'worker2')
+        self.assertEqual(store1.acquire(urls), urls)
+        self.assertEqual(store2.acquire(urls), [])
+        self.assertEqual(store1.acquire(urls), urls[:3])
+        self.assertEqual(store2.acquire(urls), urls[3:])
+
+        store1.release(urls[:1])
+        self.assertEqual(store2.acquire(urls), urls[:1] + urls[3:])
+        store1.release()
+        self.assertEqual(store2.acquire(urls), urls)
+
+        with patch.object(time, 'time',
+                return_value=time.time() + itemz.SHARD_LEASE_DURATION + 1):
+            self.assertEqual(store1.acquire(urls), urls)
+        store1.close()
+        store2.close()
+
+    def test_notifications(self):
+        store = itemz.ShardStore(os.path.join(self.work_path, 'shards.db'),
+            'worker1')
+        store.add_notification('title1', 'body1')
+        store.add_notification('title2', 'body2')
+        self.assertEqual(store.pop_notifications(),
+            [(1, 'title1', 'body1'), (2, 'title2', 'body2')])
+        self.assertEqual(store.pop_notifications(), [])
+        store.close()
+
+    def test_item_index(self):
+        file = os.path.join(self.work_path, 'shards.db')
+        index1 = itemz.ItemIndex(os.path.join(self.work_path, 'items1'))
+        index2 = itemz.ItemIndex(os.path.join(self.work_path, 'items2'))
+        index1.shard_store = itemz.ShardStore(file, 'worker1')
+        index2.shard_store = itemz.ShardStore(file, 'worker2')
+        self.assertEqual(index1.add('https://a.com/1', ['Name 1']), set())
+        self.assertEqual(index2.add('https://b.com/1',
+            ['Name 1', 'Name 2']), {'Name 1'})
+        self.assertEqual(index1.add('https://a.com/1', ['Name 1']), set())
+        self.assertEqual(index1.add('https://a.com/2', ['Name 2']),
+            {'Name 2'})
+
+        with patch.object(time, 'time', return_value=time.time()
+                + itemz.STORAGE_RETENTION_DELTA + 1):
+            index1.shard_store.acquire([])
+        keys = itemz.clean_items(['Name 1'])
+        self.assertEqual(index2.shard_store.index_items('https://c.com/1',
+            keys), {keys[0]: 'https://c.com/1'})
+        index1.shard_store.close()
+        index2.shard_store.close()
+
+    def test_item_storage(self):
+        with patch.object(itemz, 'SHARD_STORE_PATH',
+                os.path.join(self.work_path, 'shards.db')):
+            storage = itemz.SqliteItemStorage(self.storage_path,
+                'https://a.com/1')
+        self.assertEqual(storage.conn.execute(
+            'PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_collector(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        with patch.object(itemz, 'SHARD_STORE_PATH',
+                    os.path.join(self.work_path, 'shards.db')), \
+                patch.object(itemz, 'SHARD_WORKER_ID', 'worker1'), \
+                patch.object(itemz.ItemStorage, 'cleanup') as cleanup:
+            collector, notif_count = self._run(urls)
+            self.assertEqual(collector.urls, {'fake': urls})
+            self.assertEqual(notif_count, 0)
+            cleanup.assert_not_called()
+            store = itemz.ShardStore(itemz.SHARD_STORE_PATH, 'worker3')
+            keys = itemz.clean_items([f'item {urls[0]}'])
+            self.assertEqual(store.index_items('https://b.com/1', keys),
+                {keys[0]: urls[0]})
+            store.close()
+
+            with patch.object(itemz, 'SHARD_WORKER_ID', 'worker2'), \
+                    patch.object(itemz, 'SHARD_COORDINATOR', True):
+                collector, notif_count = self._run(urls)
+            self.assertEqual(collector.urls, {'fake': []})
+            self.assertEqual(notif_count, 2)
+            cleanup.assert_called_once()
+
+
+class KilledParser(FakeParser):
+    parsed_urls = []
+    killed = False
+
+    def parse(self, url):
+        if 'kill' in url and not KilledParser.killed:
+            KilledParser.killed = True
+            raise KeyboardInterrupt()
+        self.parsed_urls.append(url)
+        return super().parse(url)
+
+
+class RunJournalTestCase(CollectorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = os.path.join(self.work_path, 'journal.jsonl')
+        KilledParser.parsed_urls = []
+        KilledParser.killed = False
+
+    def test_journal(self):
+        journal = itemz.RunJournal(self.file)
+        self.assertEqual(journal.start('key', 3600), (set(), {}))
+        notifs = journal.add('https://a.com/1',
+            [('title', 'body1', 'key1'), ('title', 'body2', 'key1')])
+        journal.add('https://a.com/2', [])
+        journal.mark_sent(list(notifs.keys())[:1])
+        journal.close()
+        with open(self.file, 'a') as fd:
+            fd.write('{"urls": ["https://a.co')
+        pending = {k: v for k, v in notifs.items()
+            if v == ['title', 'body2', 'key1']}
+
+        urls, res = itemz.RunJournal(self.file).start('key', 3600)
+        self.assertEqual(urls, {'https://a.com/1', 'https://a.com/2'})
+        self.assertEqual(res, pending)
+        urls, res = itemz.RunJournal(self.file).start('other key', 3600)
+        self.assertEqual(urls, set())
+        self.assertEqual(res, pending)
+        with patch.object(time, 'time', return_value=time.time() + 3600):
+            urls, res = itemz.RunJournal(self.file).start('other key', 3600)
+        self.assertEqual(urls, set())
+        journal = itemz.RunJournal(self.file)
+        journal.finish()
+        self.assertFalse(os.path.exists(self.file))
+
+    def _run_killed(self, urls):
+        collector = itemz.ItemCollector(Mock(URLS={'fake': urls},
+            ITEM_STORAGE_PATH=self.storage_path))
+        collector.parsers['fake'] = KilledParser
+        with patch.object(itemz, 'Notifier') as notifier:
+            try:
+                collector.run()
+            except KeyboardInterrupt:
+                pass
+        return [c.kwargs['body']
+            for c in notifier.return_value.send.call_args_list]
+
+    def test_resume(self):
+        urls = ['https://a.com/1', 'https://a.com/kill', 'https://a.com/2']
+        bodies = self._run_killed(urls)
+        self.assertEqual(bodies, ['item https://a.com/1'])
+        self.assertTrue(os.path.exists(self.file))
+
+        bodies += self._run_killed(urls)
+        self.assertEqual(KilledParser.parsed_urls, urls)
+        self.assertEqual(sorted(bodies), sorted(f'item {r}' for r in urls))
+        self.assertFalse(os.path.exists(self.file))
+
+    def test_replay(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        journal = itemz.RunJournal(self.file)
+        journal.start(hashlib.md5(itemz.to_json({'fake': urls}).encode(
+            'utf-8')).hexdigest(), 3600)
+        journal.add(urls[0], [('itemz a.com', 'item 1', urls[0])])
+        journal.close()
+
+        bodies = self._run_killed(urls)
+        self.assertEqual(KilledParser.parsed_urls, urls[1:])
+        self.assertEqual(sorted(bodies), ['item 1', f'item {urls[1]}'])
+
+        # The journaled url items were not stored by this test
+        bodies = self._run_killed(urls)
+        self.assertEqual(bodies, [f'item {urls[0]}'])
+
+
+class CircuitBreakerTestCase(CollectorTestCase):
+    def test_breaker(self):
+        notify = Mock()
+        file = os.path.join(self.work_path, 'h')
+        breaker = itemz.CircuitBreaker(file, notify=notify)
+        url = 'https://a.com/1'
+        with patch.object(itemz, 'BREAKER_FAILURES', 2):
+            breaker.record(url, success=False)
+            self.assertTrue(breaker.allow(url))
+            breaker.record(url, success=False)
+            self.assertFalse(breaker.allow('https://a.com/2'))
+            self.assertTrue(breaker.allow('https://b.com/1'))
+            self.assertEqual(notify.call_count, 1)
+            breaker.save()
+
+            breaker = itemz.CircuitBreaker(file, notify=notify)
+            self.assertFalse(breaker.allow(url))
+            with patch.object(time, 'time',
+                    return_value=time.time() + itemz.BREAKER_MIN_BACKOFF):
+                self.assertTrue(breaker.allow(url))
+                self.assertFalse(breaker.allow(url))
+                breaker.record(url, success=False)
+            self.assertEqual(breaker.data['a.com']['backoff'],
+                itemz.BREAKER_MIN_BACKOFF * 2)
+            self.assertEqual(notify.call_count, 1)
+            breaker.record(url, success=True)
+            self.assertTrue(breaker.allow(url))
+
+    def _run_with_sink(self, urls, workers=0):
+        messages = []
+        collector = itemz.ItemCollector(Mock(URLS={'fake': urls},
+                ITEM_STORAGE_PATH=self.storage_path),
+            notification_sink=lambda *args: messages.append(args))
+        collector.parsers['fake'] = FakeParser
+        with patch.object(itemz, 'PARSER_WORKERS', workers), \
+                patch.object(itemz, 'Notifier') as notifier:
+            collector.run()
+        notifier.assert_not_called()
+        return messages
+
+    def _test_collector(self, workers):
+        urls = [f'https://a.com/error{i}' for i in range(5)]
+        with patch.object(itemz, 'BREAKER_FAILURES', 2):
+            # The url errors and the breaker alert are coalesced
+            messages = self._run_with_sink(urls, workers)
+            self.assertEqual(len(messages), 1)
+            self.assertEqual(messages[0][0], 'itemz error')
+            self.assertIn('a.com failed 2 times in a row', messages[0][1])
+            self.assertEqual(self._run_with_sink(urls, workers), [])
+
+    def test_collector(self):
+        self._test_collector(workers=0)
+
+    def test_workers(self):
+        self._test_collector(workers=1)
+
+
+class NotificationDispatcherTestCase(unittest.TestCase):
+    def test_coalesce(self):
+        messages = []
+        dispatcher = itemz.NotificationDispatcher(
+            lambda t, b: messages.append((t, b)))
+        with patch.object(itemz, 'NOTIF_MAX_PER_WINDOW', 3):
+            for i in range(5):
+                dispatcher.send(f'title{i}', 'body1')
+                dispatcher.send(f'title{i}', 'body2')
+            dispatcher.close()
+        self.assertEqual(messages, [
+            ('title0', 'body1\nbody2'),
+            ('title1', 'body1\nbody2'),
+            (itemz.NAME, 'title2: body1\nbody2\ntitle3: body1\nbody2\n'
+                'title4: body1\nbody2'),
+        ])
+
+    def test_rate_limit(self):
+        ts = []
+        dispatcher = itemz.NotificationDispatcher(
+            lambda t, b: ts.append(time.time()))
+        with patch.object(itemz, 'NOTIF_WINDOW', .1), \
+                patch.object(itemz, 'NOTIF_MIN_INTERVAL', .3):
+            dispatcher.send('title1', 'body')
+            time.sleep(.2)
+            dispatcher.send('title2', 'body')
+            dispatcher.close()
+        self.assertEqual(len(ts), 2)
+        self.assertGreaterEqual(ts[1] - ts[0], .29)
+
+    def test_sink_error(self):
+        sink = Mock(side_effect=[Exception('failed'), None])
+        dispatcher = itemz.NotificationDispatcher(sink)
+        dispatcher.send('title1', 'body')
+        dispatcher.send('title2', 'body')
+        with patch.object(itemz, 'NOTIF_MIN_INTERVAL', 0):
+            dispatcher.close()
+        self.assertEqual(sink.call_count, 2)
+
+
+class WorkersTestCase(CollectorTestCase):
+    def test_1(self):
+        urls = ['https://a.com/1', 'https://a.com/2', 'https://a.com/error']
+        collector = itemz.ItemCollector(Mock(URLS={'fake': urls},
+            ITEM_STORAGE_PATH=self.storage_path))
+        collector.parsers['fake'] = FakeParser
+        with patch.object(itemz, 'PARSER_WORKERS', 2), \
+                patch.object(itemz, 'URLS_PER_WORKER', 1), \
+                patch.object(itemz, 'Notifier') as notifier:
+            collector.run()
+        bodies = sorted(c.kwargs['body']
+            for c in notifier.return_value.send.call_args_list)
+        self.assertEqual(bodies, [
+            'failed to process https://a.com/error: parse error',
+            'item https://a.com/1',
+            'item https://a.com/2',
+        ])
+
+    def test_timeout(self):
+        urls = ['https://a.com/1', 'https://a.com/hang']
+        collector = itemz.ItemCollector(Mock(URLS={'fake': urls},
+            ITEM_STORAGE_PATH=self.storage_path))
+        collector.parsers['fake'] = HangingParser
+        with patch.object(itemz, 'PARSER_WORKERS', 2), \
+                patch.object(itemz, 'WORKER_URL_TIMEOUT', 1), \
+                patch.object(itemz, 'Notifier') as notifier:
+            collector.run()
+        bodies = sorted(c.kwargs['body']
+            for c in notifier.return_value.send.call_args_list)
+        self.assertEqual(bodies, [
+            'failed to process fake: timed out with 1 unprocessed urls',
+            'item https://a.com/1',
+        ])
+
+    def test_known_items(self):
+        urls = ['https://a.com/1', 'https://a.com/2']
+        for url in urls:
+            itemz.SqliteItemStorage(self.storage_path, url).save(
+                {'old 1': 1, 'old 2': 2}, {'old 1': 1, 'old 2': 2})
+        collector = itemz.ItemCollector(Mock(URLS={'fake': urls},
+            ITEM_STORAGE_PATH=self.storage_path))
+        collector.parsers['fake'] = KnownItemsParser
+        locked = threading.Event()
+
+        def hold_lock():
+            # Held by a collector thread while the workers are forked
+            with itemz.SqliteItemStorage.lock:
+                locked.set()
+                time.sleep(1)
+
+        threading.Thread(target=hold_lock).start()
+        locked.wait()
+        with patch.object(itemz, 'PARSER_WORKERS', 2), \
+                patch.object(itemz, 'URLS_PER_WORKER', 1), \
+                patch.object(itemz, 'KNOWN_ITEMS_STOP', 2), \
+                patch.object(itemz, 'Notifier') as notifier:
+            collector.run()
+        bodies = sorted(c.kwargs['body']
+            for c in notifier.return_value.send.call_args_list)
+        self.assertEqual(bodies, ['item https://a.com/1',
+            'item https://a.com/2'])
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class HttpParserTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0),
+            partial(QuietHandler, directory=FIXTURES_PATH))
+        threading.Thread(target=cls.server.serve_forever,
+            daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.parser = itemz.X1337xHttpParser()
+        self.parser.fallback = Mock()
+        self.parser.fallback.parse.return_value = {'fallback': 1}
+
+    def tearDown(self):
+        self.parser.fallback = None
+        self.parser.quit()
+
+    def test_rows(self):
+        res = self.parser.parse(f'{self.base_url}/1337x_user.html')
+        self.assertEqual(sorted(res.items(), key=lambda x: -x[1])[0][0],
+            'Monster Hunter Wilds (v1.0 + DLC, MULTi13) [FitGirl Repack]')
+        self.assertEqual(sorted(res.keys()), [
+            'L.A. Noire: The Complete Edition & DLCs',
+            'Monster Hunter Wilds (v1.0 + DLC, MULTi13) [FitGirl Repack]',
+        ])
+        self.assertFalse(self.parser.fallback.parse.called)
+
+    def test_no_results(self):
+        res = self.parser.parse(f'{self.base_url}/1337x_no_results.html')
+        self.assertEqual(res, {})
+        self.assertFalse(self.parser.fallback.parse.called)
+
+    def test_challenge(self):
+        res = self.parser.parse(f'{self.base_url}/1337x_challenge.html')
+        self.assertEqual(res, {'fallback': 1})
+
+    def test_inline(self):
+        res = self.parser.parse(f'{self.base_url}/1337x_inline.html')
+        self.assertEqual(sorted(res.keys()),
+            ['Cyberpunk 2077', 'Elden Ring v1.0'])
+        self.assertFalse(self.parser.fallback.parse.called)
+
+    def test_not_modified(self):
+        url = f'{self.base_url}/1337x_user.html'
+        self.assertEqual(len(self.parser.parse(url)), 2)
+        self.assertTrue(self.parser.validators[url]['last_modified'])
+        self.assertIsNone(self.parser.parse(url))
+
+    def test_not_found(self):
+        res = self.parser.parse(f'{self.base_url}/missing.html')
+        self.assertEqual(res, {'fallback': 1})
+
+
+class ItemStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.base_path,
+            itemz.ItemStorage.manifest_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_cleanup(self):
+        urls = [f'https://a.com/{i}' for i in range(4)]
+        paths = []
+        for url in urls:
+            storage = itemz.ItemStorage(self.base_path, url)
+            storage.save({'a': 1}, {'a': 1})
+            paths.append(storage.path)
+        self.assertEqual(set(itemz.load_json(self.manifest_file).keys()),
+            {os.path.basename(r) for r in paths})
+
+        itemz.ItemStorage.cleanup(self.base_path, urls[:1])
+        self.assertTrue(all(os.path.exists(r) for r in paths))
+
+        with patch.object(time, 'time',
+                    return_value=time.time()
+                        + itemz.STORAGE_RETENTION_DELTA + 1), \
+                patch.object(itemz, 'STORAGE_CLEANUP_BUDGET', 2):
+            itemz.ItemStorage.cleanup(self.base_path, urls[:1])
+            self.assertTrue(os.path.exists(paths[0]))
+            self.assertEqual(len([r for r in paths if os.path.exists(r)]), 2)
+            itemz.ItemStorage.cleanup(self.base_path, urls[:1])
+            self.assertEqual([os.path.exists(r) for r in paths],
+                [True, False, False, False])
+        self.assertEqual(list(itemz.load_json(self.manifest_file).keys()),
+            [os.path.basename(paths[0])])
+
+    def test_missing_manifest(self):
+        url = 'https://a.com/1'
+        storage = itemz.ItemStorage(self.base_path, url)
+        storage.save({'a': 1}, {'a': 1})
+        os.remove(self.manifest_file)
+        with patch.object(itemz, 'STORAGE_RETENTION_DELTA', -10):
+            itemz.ItemStorage.cleanup(self.base_path, [url])
+            self.assertTrue(os.path.exists(storage.path))
+            itemz.ItemStorage.cleanup(self.base_path, [])
+        self.assertFalse(os.path.exists(storage.path))
+        self.assertEqual(itemz.load_json(self.manifest_file), {})
+
+
+class SqliteItemStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.url = 'https://1337x.to/user/FitGirl/'
+
+    def tearDown(self):
+        itemz.SqliteItemStorage.close()
+        shutil.rmtree(self.base_path)
+
+    def test_new_items(self):
+        storage = itemz.SqliteItemStorage(self.base_path, self.url)
+        all_items = {'a': 3, 'b': 2}
+        self.assertEqual(storage.get_new_items(all_items), all_items)
+        storage.save(all_items, all_items)
+        storage = itemz.SqliteItemStorage(self.base_path, self.url)
+        self.assertEqual(storage.get_new_items({'c': 4, 'a': 3}), {'c': 4})
+        other = itemz.SqliteItemStorage(self.base_path, 'https://other')
+        self.assertEqual(other.get_new_items({'a': 3}), {'a': 3})
+
+    def test_migration(self):
+        legacy = itemz.ItemStorage(self.base_path, self.url)
+        legacy.save({'a': 3, 'b': 2}, {'a': 3, 'b': 2})
+        legacy.save({'a': 3, 'c': 4}, {'c': 4})
+        storage = itemz.SqliteItemStorage(self.base_path, self.url)
+        self.assertFalse(os.path.exists(legacy.path))
+        self.assertEqual(storage.get_new_items({'a': 5, 'c': 4, 'd': 6}),
+            {'d': 6})
+
+    def test_failed_migration(self):
+        legacy = itemz.ItemStorage(self.base_path, self.url)
+        legacy.save({'a': 3}, {'a': 3})
+        store = Mock(side_effect=sqlite3.OperationalError('locked'))
+        self.assertRaises(sqlite3.OperationalError,
+            itemz.migrate_legacy_items, self.base_path, self.url, store)
+        store.assert_called_once_with({'a': 3}, ANY)
+        self.assertTrue(os.path.exists(legacy.path))
+        storage = itemz.SqliteItemStorage(self.base_path, self.url)
+        self.assertFalse(os.path.exists(legacy.path))
+        self.assertEqual(storage.get_new_items({'a': 3}), {})
+
+    def test_cleanup(self):
+        storage = itemz.SqliteItemStorage(self.base_path, self.url)
+        storage.save({'a': 1}, {'a': 1})
+        with patch.object(itemz, 'STORAGE_RETENTION_DELTA', -10):
+            itemz.SqliteItemStorage.cleanup(self.base_path, [self.url])
+            self.assertEqual(storage.get_new_items({'a': 1}), {})
+            itemz.SqliteItemStorage.cleanup(self.base_path, [])
+        self.assertEqual(storage.get_new_items({'a': 1}), {'a': 1})
+
+    def test_cleanup_budget(self):
+        urls = [f'https://a.com/{i}' for i in range(3)]
+        storages = [itemz.SqliteItemStorage(self.base_path, r) for r in urls]
+        for storage in storages:
+            storage.save({'a': 1}, {'a': 1})
+        with patch.object(itemz, 'STORAGE_RETENTION_DELTA', -10), \
+                patch.object(itemz, 'STORAGE_CLEANUP_BUDGET', 2):
+            itemz.SqliteItemStorage.cleanup(self.base_path, [])
+            self.assertEqual(len([r for r in storages
+                if r.get_new_items({'a': 1})]), 2)
+            itemz.SqliteItemStorage.cleanup(self.base_path, [])
+        self.assertTrue(all(r.get_new_items({'a': 1}) for r in storages))
+
+
+class DigestItemStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.url = 'https://1337x.to/user/FitGirl/'
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_new_items(self):
+        storage = itemz.DigestItemStorage(self.base_path, self.url)
+        all_items = {'a': 3, 'b': 2}
+        self.assertEqual(storage.get_new_items(all_items), all_items)
+        storage.save(all_items, all_items)
+        self.assertEqual(storage.get_new_items({'c': 4, 'a': 3}), {'c': 4})
+        storage.save({'c': 4, 'a': 3}, {'c': 4})
+        storage = itemz.DigestItemStorage(self.base_path, self.url)
+        self.assertEqual(os.path.getsize(storage.file), 3 * 8)
+        self.assertEqual(storage.get_new_items(
+            {'a': 1, 'b': 1, 'c': 1, ' c ': 1, 'd': 1}), {'d': 1})
+
+    def test_migration(self):
+        legacy = itemz.ItemStorage(self.base_path, self.url)
+        legacy.save({'a': 3, 'b': 2}, {'a': 3, 'b': 2})
+        with patch.object(itemz.DigestItemStorage, '_write',
+                side_effect=OSError('disk full')):
+            self.assertRaises(OSError, itemz.DigestItemStorage,
+                self.base_path, self.url)
+        self.assertTrue(os.path.exists(legacy.path))
+        storage = itemz.DigestItemStorage(self.base_path, self.url)
+        self.assertFalse(os.path.exists(legacy.path))
+        self.assertEqual(storage.get_new_items({'a': 5, 'd': 6}), {'d': 6})
+
+    def test_cleanup(self):
+        urls = [f'https://a.com/{i}' for i in range(4)]
+        files = []
+        for url in urls:
+            storage = itemz.DigestItemStorage(self.base_path, url)
+            storage.save({'a': 1}, {'a': 1})
+            files.append(storage.file)
+        manifest_file = os.path.join(self.base_path,
+            itemz.DigestItemStorage.manifest_filename)
+        self.assertEqual(set(itemz.load_json(manifest_file).keys()),
+            {os.path.basename(r) for r in files})
+
+        # Only the first legacy storage cleanup scans the storage path
+        itemz.DigestItemStorage.cleanup(self.base_path, urls[:1])
+        with patch.object(itemz, 'glob') as glob_:
+            itemz.DigestItemStorage.cleanup(self.base_path, urls[:1])
+        glob_.assert_not_called()
+        self.assertTrue(all(os.path.exists(r) for r in files))
+
+        with patch.object(time, 'time',
+                    return_value=time.time()
+                        + itemz.STORAGE_RETENTION_DELTA + 1), \
+                patch.object(itemz, 'STORAGE_CLEANUP_BUDGET', 2):
+            itemz.DigestItemStorage.cleanup(self.base_path, urls[:1])
+            self.assertEqual(len([r for r in files if os.path.exists(r)]), 2)
+            itemz.DigestItemStorage.cleanup(self.base_path, urls[:1])
+            self.assertEqual([os.path.exists(r) for r in files],
+                [True, False, False, False])
+        self.assertEqual(list(itemz.load_json(manifest_file).keys()),
+            [os.path.basename(files[0])])